@@ -1,6 +1,10 @@
 #!/usr/bin/python
-"""Note: Currently depends on local data"""
+"""Note: Currently depends on local data
+
+Usage: acceptance_tests.py [auto|bindings|svnlook]"""
 import os
+import sys
+import svn_look_wrappers
 from svn_look_wrappers import CommitDetails, RepositoryDetails
 from ordered_filename_pre_commit import check_filenames
 from require_commit_message_pre_commit import check_commit_message
@@ -12,6 +16,11 @@ REPO = "dummy-svn-server/repository"
 if not os.path.isdir(REPO):
     raise AssertionError("Test SVN repository required!")
 
+svn_look_wrappers.SVNLOOK_DEBUG = True
+
+if len(sys.argv) > 1:
+    svn_look_wrappers.SVNLOOK_BACKEND = sys.argv[1]
+
 def revisions(first, last):
     for i in range(first, last + 1):
         print "Revision %d" % i
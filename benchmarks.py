@@ -0,0 +1,198 @@
+#!/usr/bin/python
+"""Times the checks end to end against a synthetic repository.
+
+Requires svnadmin. The repository is generated as a dump stream and loaded
+with a single 'svnadmin load', which is far faster than committing.
+
+Revision 1 adds the modules with their migrations, revision 2 copies trunk of
+each module to its tags and revision 3 is the large commit that is checked."""
+import os
+import sys
+import time
+import shutil
+import optparse
+import resource
+import tempfile
+import traceback
+import subprocess
+import svn_look_wrappers
+from svn_look_wrappers import CommitDetails, RepositoryDetails
+from ordered_filename_pre_commit import check_filenames, MIGRATION_PATH
+from require_commit_message_pre_commit import check_commit_message
+from no_changes_in_tags_pre_commit import fail_on_tag_changes
+
+DATE = "2012-08-24T00:00:00.000000Z"
+
+def properties(**props):
+    lines = []
+    for name, value in sorted(props.items()):
+        name = name.replace("_", ":", 1)
+        lines.append("K %d\n%s\nV %d\n%s\n" % (len(name), name, len(value), value))
+    lines.append("PROPS-END\n")
+    return "".join(lines)
+
+def write_revision(dump, revision, message):
+    props = properties(svn_log=message, svn_author="benchmark", svn_date=DATE)
+    dump.write("Revision-number: %d\nProp-content-length: %d\nContent-length: %d\n\n%s\n"
+               % (revision, len(props), len(props), props))
+
+def write_directory(dump, path, copied_from=None):
+    dump.write("Node-path: %s\nNode-kind: dir\nNode-action: add\n" % path)
+    if copied_from:
+        dump.write("Node-copyfrom-rev: %d\nNode-copyfrom-path: %s\n\n\n" % copied_from)
+    else:
+        empty = properties()
+        dump.write("Prop-content-length: %d\nContent-length: %d\n\n%s\n\n" % (len(empty), len(empty), empty))
+
+def write_file(dump, path, text):
+    empty = properties()
+    dump.write("Node-path: %s\nNode-kind: file\nNode-action: add\n" % path)
+    dump.write("Prop-content-length: %d\nText-content-length: %d\nContent-length: %d\n\n%s%s\n\n"
+               % (len(empty), len(text), len(empty) + len(text), empty, text))
+
+def write_directories(dump, path, created):
+    parts = path.rstrip("/").split("/")
+    for depth in range(1, len(parts) + 1):
+        directory = "/".join(parts[:depth])
+        if directory not in created:
+            created.add(directory)
+            write_directory(dump, directory)
+
+def generate_dump(dump, options):
+    dump.write("SVN-fs-dump-format-version: 2\n\n")
+    props = properties(svn_date=DATE)
+    dump.write("Revision-number: 0\nProp-content-length: %d\nContent-length: %d\n\n%s\n"
+               % (len(props), len(props), props))
+
+    write_revision(dump, 1, "Add modules")
+    created = set()
+    for module in range(options.modules):
+        migration_dir = "module%d/%s" % (module, MIGRATION_PATH)
+        write_directories(dump, migration_dir, created)
+        write_directory(dump, "module%d/tags" % module)
+        for migration in range(options.migrations):
+            number = migration * options.modules + module
+            write_file(dump, "%s%06d_migration.rb" % (migration_dir, number), "migration\n")
+
+    write_revision(dump, 2, "Tag modules")
+    for tag in range(options.tags):
+        module = tag % options.modules
+        write_directory(dump, "module%d/tags/%d.0" % (module, tag), (1, "module%d/trunk" % module))
+
+    write_revision(dump, 3, "Large commit %s" % options.commit_size)
+    import_dir = "module0/trunk/import/"
+    created = set()
+    for path in range(options.commit_size):
+        file_dir = "%s%d/" % (import_dir, path / 1000)
+        write_directories(dump, file_dir, created)
+        write_file(dump, "%s%d.txt" % (file_dir, path), "content\n")
+    last_number = options.migrations * options.modules
+    write_file(dump, "module0/%s%06d_migration.rb" % (MIGRATION_PATH, last_number), "migration\n")
+
+def create_repository(repository, options):
+    subprocess.check_call(["svnadmin", "create", repository])
+    dump_path = repository + ".dump"
+    dump = open(dump_path, "w")
+    try:
+        generate_dump(dump, options)
+    finally:
+        dump.close()
+    dev_null = open(os.devnull, "w")
+    try:
+        subprocess.check_call(["svnadmin", "load", "--quiet", repository],
+                              stdin=open(dump_path), stdout=dev_null)
+    finally:
+        dev_null.close()
+        os.remove(dump_path)
+
+CHECKS = [
+    ("commit-message", lambda commit_details, repository_details:
+        check_commit_message(commit_details)),
+    ("no-tag-changes", lambda commit_details, repository_details:
+        fail_on_tag_changes(commit_details)),
+    ("ordered-filenames", check_filenames),
+]
+
+def measure(repository, revision, check):
+    "Runs the check in a child process, returning its latency and peak RSS in kB."
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            try:
+                os.close(read_end)
+                started = time.time()
+                commit_details = CommitDetails(repository, revision, test_mode=True)
+                repository_details = RepositoryDetails(repository, revision, test_mode=True)
+                sys.stderr = open(os.devnull, "w")
+                result = check(commit_details, repository_details)
+                elapsed = time.time() - started
+                peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                os.write(write_end, "%f %d %d" % (elapsed, peak_rss, result))
+                status = 0
+            except:
+                os.write(write_end, "error " + traceback.format_exc())
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    chunks = []
+    chunk = os.read(read_end, 65536)
+    while chunk:
+        chunks.append(chunk)
+        chunk = os.read(read_end, 65536)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    output = "".join(chunks)
+    if not output or output.startswith("error "):
+        raise RuntimeError("The check failed in the benchmark process:\n%s" % output[len("error "):])
+    elapsed, peak_rss, result = output.split()
+    return float(elapsed), int(peak_rss), int(result)
+
+def main():
+    usage = """Usage: %prog [options] [CHECK...]
+
+Generates a synthetic repository and times the checks against its largest
+commit, reporting latency and peak RSS per check."""
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--modules", type="int", default=100, help="Number of modules. Default is 100.")
+    parser.add_option("--migrations", type="int", default=20, help="Migrations per module. Default is 20.")
+    parser.add_option("--tags", type="int", default=100, help="Number of tags. Default is 100.")
+    parser.add_option("--commit-size", type="int", default=10000,
+                      help="Number of paths in the checked commit, up to 100000. Default is 10000.")
+    parser.add_option("--repeat", type="int", default=3, help="Runs per check. Default is 3.")
+    parser.add_option("--repository", help="Where to create the repository. Default is a temporary directory.")
+    parser.add_option("--keep", action="store_true", default=False, help="Keep the generated repository.")
+    parser.add_option("-b", "--backend", help="Backend to benchmark: auto, bindings or svnlook.")
+    (options, checks) = parser.parse_args()
+    if options.backend:
+        svn_look_wrappers.SVNLOOK_BACKEND = options.backend
+
+    temp_dir = None
+    repository = options.repository
+    if repository is None:
+        temp_dir = tempfile.mkdtemp(prefix="pre-commit-benchmark-")
+        repository = os.path.join(temp_dir, "repository")
+    try:
+        started = time.time()
+        create_repository(repository, options)
+        print "Created %s with %d modules, %d migrations per module, %d tags and a %d path commit in %.1fs" \
+            % (repository, options.modules, options.migrations, options.tags, options.commit_size,
+               time.time() - started)
+        print
+        print "%-20s %10s %10s %14s %8s" % ("Check", "Best (s)", "Worst (s)", "Peak RSS (kB)", "Result")
+        for name, check in CHECKS:
+            if checks and name not in checks:
+                continue
+            runs = [measure(repository, 3, check) for i in range(options.repeat)]
+            latencies = [elapsed for elapsed, peak_rss, result in runs]
+            print "%-20s %10.3f %10.3f %14d %8d" % (name, min(latencies), max(latencies),
+                                                    max(peak_rss for elapsed, peak_rss, result in runs),
+                                                    runs[-1][2])
+    finally:
+        if temp_dir and not options.keep:
+            shutil.rmtree(temp_dir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
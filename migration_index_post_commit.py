@@ -0,0 +1,28 @@
+#!/usr/bin/python
+import sys
+import optparse
+from svn_look_wrappers import RepositoryDetails, SvnLookError
+from ordered_filename_pre_commit import load_migration_index
+from path_rules import add_rules_option, get_rules, RulesError
+
+def main():
+    usage = """Usage: %prog REPOS REV INDEX
+
+Runs post-commit, updating the migration index used by
+ordered_filename_pre_commit.py --migration-index with the committed revision."""
+    parser = optparse.OptionParser(usage=usage)
+    add_rules_option(parser)
+    try:
+        (options, (repos, revision, index_path)) = parser.parse_args()
+        load_migration_index(index_path, RepositoryDetails(repos, revision, test_mode=True),
+                             get_rules(options, repos))
+        return 0
+    except (SvnLookError, RulesError) as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
+    except:
+        parser.print_help()
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,51 @@
 #!/usr/bin/python
 import sys
-import re
-from svn_look_wrappers import get_option_parser, build_wrappers
+from svn_look_wrappers import get_option_parser, create_wrappers, SvnLookError, timed_check
+from path_rules import Rule, RuleSet, TAG, add_rules_option, get_rules, with_defaults, RulesError
 
-# Files matching this pattern will be treated as tagged
-TAGS_PATH_PATTERN = "^[^/]+/tags/.+"
+# Files below this path will be treated as tagged. * matches any single directory.
+TAGS_PATH = "*/tags/"
 # Check will be skipped if commit message contains the SKIP_KEYWORD
 SKIP_KEYWORD = "skip-tag-check"
+# Statuses of changes that are not permitted on tagged files, unless copied
+MODIFYING_STATUSES = ("A", "U", "_")
 
-def fail_on_tag_changes(commit_details):
+# Used when the repository has no rules file
+DEFAULT_RULES = RuleSet([Rule(TAG, TAG, TAGS_PATH)])
+
+@timed_check("no-tag-changes")
+def fail_on_tag_changes(commit_details, rules=None):
     if SKIP_KEYWORD in commit_details.get_commit_message().split():
         return 0
-    for modified_file in commit_details.get_files():
-        if re.match(TAGS_PATH_PATTERN, modified_file):
-            copied_and_deleted_files = commit_details.get_copied_files()
-            copied_and_deleted_files.extend(commit_details.get_deleted_files())
-            if modified_file not in copied_and_deleted_files:
-                sys.stderr.write("Error: Modifying tagged files is not permitted!\n")
-                return 1
+    tag_paths = [rule.path for rule in with_defaults(rules, DEFAULT_RULES).get_rules(TAG)]
+    modified_tagged_files = [modified_file for status, modified_file, copied
+                             in commit_details.get_changes_under(tag_paths)
+                             if status in MODIFYING_STATUSES and not copied
+                             and is_tagged(modified_file, rules)]
+    if modified_tagged_files:
+        sys.stderr.write("Error: Modifying tagged files is not permitted!\n")
+        for modified_file in modified_tagged_files:
+            sys.stderr.write("  %s\n" % modified_file)
+        return 1
     return 0
 
+def is_tagged(file_path, rules=None):
+    return with_defaults(rules, DEFAULT_RULES).classify(file_path, TAG) is not None
+
 def main():
     usage = """Usage: %prog REPOS TXN
 
 Runs pre-commit verification on a repository transaction, disallowing modification
 of tagged files."""
     parser = get_option_parser(usage)
+    add_rules_option(parser)
     try:
-        commit_details, repository_details = build_wrappers(parser)
-        return fail_on_tag_changes(commit_details)
+        (options, (repos, transaction_or_revision)) = parser.parse_args()
+        commit_details, repository_details = create_wrappers(options, repos, transaction_or_revision)
+        return fail_on_tag_changes(commit_details, get_rules(options, repos))
+    except (SvnLookError, RulesError) as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
     except:
         parser.print_help()
         return 1
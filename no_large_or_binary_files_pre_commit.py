@@ -0,0 +1,80 @@
+#!/usr/bin/python
+import sys
+from svn_look_wrappers import get_option_parser, create_wrappers, parallel_map, SvnLookError, timed_check
+from path_rules import Rule, RuleSet, ASSET, add_rules_option, get_rules, with_defaults, RulesError
+
+# Largest permitted file size in bytes outside ASSETS_PATH
+MAX_FILE_SIZE = 1024 * 1024
+# Bytes read from the start of each file to tell binary files from text files
+BINARY_SNIFF_SIZE = 1024
+# Largest share of control characters in the start of a text file. A file
+# containing a NUL byte is always binary.
+MAX_CONTROL_CHARACTER_RATIO = 0.15
+# Large and binary files are permitted below this path. * matches any single directory.
+ASSETS_PATH = "*/trunk/assets/"
+# Check will be skipped if commit message contains the SKIP_KEYWORD
+SKIP_KEYWORD = "skip-file-check"
+
+# Used when the repository has no rules file
+DEFAULT_RULES = RuleSet([Rule(ASSET, ASSET, ASSETS_PATH)])
+
+CONTROL_CHARACTERS = "".join(chr(code) for code in range(32) if chr(code) not in "\b\t\n\f\r\x1b") + "\x7f"
+
+@timed_check("no-large-or-binary-files")
+def check_files(commit_details, rules=None):
+    if SKIP_KEYWORD in commit_details.get_commit_message().split():
+        return 0
+    files = [file for file in commit_details.get_added_files() + commit_details.get_modified_files()
+             if not file.endswith("/") and not is_asset(file, rules)]
+    error = 0
+    for file, (size, binary) in zip(files, parallel_map(lambda file: inspect_file(commit_details, file), files)):
+        if size > MAX_FILE_SIZE:
+            sys.stderr.write("Error: The file \"%s\" is %d bytes, larger than the permitted %d bytes.\n"
+                             % (file, size, MAX_FILE_SIZE))
+            error += 1
+        elif binary:
+            sys.stderr.write("Error: The file \"%s\" is binary.\n" % file)
+            error += 1
+    if error > 0:
+        asset_paths = [rule.path for rule in with_defaults(rules, DEFAULT_RULES).get_rules(ASSET)]
+        if asset_paths:
+            sys.stderr.write("Large and binary files may only be committed below %s.\n" % ", ".join(asset_paths))
+        sys.stderr.write("If you want to commit this anyway, include \"%s\" in the commit message.\n" % SKIP_KEYWORD)
+    return error
+
+def inspect_file(commit_details, file):
+    "Returns the size of the file and whether it is binary, reading at most the start of it."
+    size = commit_details.get_file_size(file)
+    if size == 0 or size > MAX_FILE_SIZE:
+        return size, False
+    return size, is_binary(commit_details.read_file_start(file, BINARY_SNIFF_SIZE))
+
+def is_binary(data):
+    if "\0" in data:
+        return True
+    control_characters = len(data) - len(data.translate(None, CONTROL_CHARACTERS))
+    return control_characters > len(data) * MAX_CONTROL_CHARACTER_RATIO
+
+def is_asset(file_path, rules=None):
+    return with_defaults(rules, DEFAULT_RULES).classify(file_path, ASSET) is not None
+
+def main():
+    usage = """Usage: %prog REPOS TXN
+
+Runs pre-commit verification on a repository transaction, disallowing large
+and binary files outside the asset paths."""
+    parser = get_option_parser(usage)
+    add_rules_option(parser)
+    try:
+        (options, (repos, transaction_or_revision)) = parser.parse_args()
+        commit_details, repository_details = create_wrappers(options, repos, transaction_or_revision)
+        return check_files(commit_details, get_rules(options, repos))
+    except (SvnLookError, RulesError) as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
+    except:
+        parser.print_help()
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
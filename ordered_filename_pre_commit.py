@@ -1,7 +1,13 @@
 #!/usr/bin/python
 import sys
+import os
 import re
-from svn_look_wrappers import get_option_parser, build_wrappers
+import json
+import bisect
+import tempfile
+from svn_look_wrappers import get_option_parser, create_wrappers, parallel_map, \
+    CommitDetails, RepositoryDetails, SvnLookError, timed_check
+from path_rules import Rule, RuleSet, MIGRATION, add_rules_option, get_rules, with_defaults, RulesError
 
 # Sub path to check. Final path will result in root_module/<MIGRATION_PATH>, 
 # e.g. mymodule/trunk/db/migrations/
@@ -9,42 +15,82 @@ MIGRATION_PATH = "trunk/db/migrations/"
 # Incoming filename pattern in MIGRATION_PATH to check.
 # "[0-9].rb" would match mymodule/trunk/db/migrations/1.rb
 FILE_PATTERN = "[0-9]+.*\.rb$"
+# How existing files are found. "tree" streams the whole repository tree from a
+# single svnlook call, "modules" lists MIGRATION_PATH in each root directory
+# with one svnlook call per directory, running up to SVNLOOK_JOBS at a time.
+MIGRATION_DISCOVERY = "tree"
+# A stale migration index is updated revision by revision when it is at most
+# this many revisions behind, and rebuilt from the repository tree otherwise.
+MIGRATION_INDEX_MAX_CATCH_UP = 100
+# Least number of seconds that must be left before the commit deadline to read
+# the existing files. With less time left, the check is degraded right away.
+EXISTING_FILES_MIN_SECONDS = 2
+# Statuses of the changed files that are checked: added, deleted and modified
+CHECKED_STATUSES = ("A", "D", "U")
 # Ignores the pre-commit check if the keyword is included in the commit message
 SKIP_KEYWORD = "skip-migration-check"
 
 # Path to svnlook executable
 SVNLOOK_COMMAND = "svnlook"
 
-def check_filenames(commit_details, repository_details):
+# Used when the repository has no rules file. Matching files of each
+# [migrations] rule are ordered separately.
+DEFAULT_RULES = RuleSet([Rule(MIGRATION, MIGRATION, "*/" + MIGRATION_PATH, FILE_PATTERN)])
+
+LEADING_NUMBER = re.compile("[0-9]+")
+
+@timed_check("ordered-filenames")
+def check_filenames(commit_details, repository_details, migration_index=None, rules=None,
+                    migration_index_loader=None):
+    """Checks the changed matching files against the existing ones. Instead of a
+    migration index, a loader of one may be given, which is only called when the
+    commit changes matching files."""
     if should_skip_check_for_commit(commit_details):
         return 0
-    error = 0
-    last_existing_file = None
-    added_files = commit_details.get_added_files()
-    deleted_files = commit_details.get_deleted_files()
-    modified_files = commit_details.get_modified_files()
-    changed_files = []
-    changed_files.extend(added_files)
-    changed_files.extend(deleted_files)
-    changed_files.extend(modified_files)
-    for changed_file in changed_files:
-        if should_check_file(changed_file):
-            if last_existing_file is None:
-                last_existing_filename = get_last_existing_matching_file(changed_files, repository_details)
-            if last_existing_filename and last_existing_filename > get_filename(changed_file):
-                if changed_file in added_files:
-                    sys.stderr.write("Error: The added file \"%s\" must have a filename \
+    rules = with_defaults(rules, DEFAULT_RULES)
+    last_existing_filenames = None
+    violations = []
+    last_filenames = {}
+    migration_paths = [rule.path for rule in rules.get_rules(MIGRATION)]
+    for status, changed_file, copied in commit_details.get_changes_under(migration_paths):
+        rule = status in CHECKED_STATUSES and get_matching_rule(changed_file, rules)
+        if rule:
+            if last_existing_filenames is None:
+                last_existing_filenames = get_last_existing_matching_files(
+                    get_changed_files(commit_details), repository_details, migration_index,
+                    commit_details, rules, migration_index_loader)
+                last_filenames.update(last_existing_filenames)
+            last_existing_filename = last_existing_filenames.get(rule.name)
+            filename = get_filename(changed_file)
+            if last_existing_filename and last_existing_filename > filename:
+                violations.append((status, changed_file, rule.name, last_existing_filename))
+            elif status == "A" and filename > last_filenames.get(rule.name, ""):
+                last_filenames[rule.name] = filename
+    for status, changed_file, rule_name, last_existing_filename in violations:
+        if status == "A":
+            sys.stderr.write("Error: The added file \"%s\" must have a filename \
 alphabetically after the existing \"%s\".\n" % (changed_file, last_existing_filename))
-                elif changed_file in modified_files:
-                    sys.stderr.write("Error: The file \"%s\" may not be modified \
+            next_filename = get_next_filename(last_filenames[rule_name], get_filename(changed_file))
+            if next_filename:
+                sys.stderr.write("It could be added as \"%s\" instead.\n"
+                                 % (get_file_dir(changed_file) + next_filename))
+                last_filenames[rule_name] = next_filename
+        elif status == "U":
+            sys.stderr.write("Error: The file \"%s\" may not be modified \
 since later migrations exist (\"%s\").\n" % (changed_file, last_existing_filename))
-                else:
-                    sys.stderr.write("Error: The file \"%s\" may not be deleted \
+        else:
+            sys.stderr.write("Error: The file \"%s\" may not be deleted \
 since later migrations exist (\"%s\").\n" % (changed_file, last_existing_filename))
-                error += 1
-    if error > 0:
+    if violations:
         output_ignore_message()
-    return error
+    return len(violations)
+
+def get_changed_files(commit_details):
+    changed_files = []
+    changed_files.extend(commit_details.get_added_files())
+    changed_files.extend(commit_details.get_deleted_files())
+    changed_files.extend(commit_details.get_modified_files())
+    return changed_files
 
 def should_skip_check_for_commit(commit_details):
     return SKIP_KEYWORD in commit_details.get_commit_message().split()
@@ -52,8 +98,11 @@ def should_skip_check_for_commit(commit_details):
 def output_ignore_message():
     sys.stderr.write("If you want to commit this anyway, include \"%s\" in the commit message.\n" % SKIP_KEYWORD)
 
-def should_check_file(file_path):
-    return bool(re.match("^[^/]+/" + MIGRATION_PATH + FILE_PATTERN, file_path))
+def get_matching_rule(file_path, rules=None):
+    return with_defaults(rules, DEFAULT_RULES).classify(file_path, MIGRATION)
+
+def should_check_file(file_path, rules=None):
+    return get_matching_rule(file_path, rules) is not None
 
 def get_file_dir(filename):
     return filename[:filename.rfind("/") + 1]
@@ -61,22 +110,229 @@ def get_file_dir(filename):
 def get_filename(filename):
     return filename[filename.rfind("/") + 1:]
 
-def get_last_existing_matching_file(files, repository_details):
-    existing_matched_files = get_existing_matching_filenames(files, repository_details)
-    existing_matched_files.sort()
-    if existing_matched_files:
-        return existing_matched_files[-1]
-    return ""
+def get_next_filename(last_filename, filename):
+    """Returns the filename with its leading number replaced by the one following
+    the leading number of last_filename, or None if that would not sort after it."""
+    last_number = LEADING_NUMBER.match(last_filename)
+    if last_number is None:
+        return None
+    number = last_number.group()
+    own_number = LEADING_NUMBER.match(filename)
+    rest = filename[own_number.end():] if own_number else "_" + filename
+    next_filename = str(int(number) + 1).zfill(len(number)) + rest
+    if next_filename <= last_filename:
+        return None
+    return next_filename
+
+def get_last_existing_matching_files(files, repository_details, migration_index=None,
+                                     commit_details=None, rules=None, migration_index_loader=None):
+    "Returns the alphabetically last existing filename of each rule, ignoring the given files."
+    if (migration_index is not None or migration_index_loader is not None) and \
+            can_use_migration_index(commit_details, rules):
+        if migration_index is None:
+            migration_index = migration_index_loader()
+        if migration_index is not None:
+            return migration_index.get_last_filenames(files)
+    deadline = repository_details.get_deadline()
+    if deadline is not None:
+        deadline.require(EXISTING_FILES_MIN_SECONDS, "reading the existing files")
+    last_existing_filenames = {}
+    files = set(files)
+    for file_path in get_existing_file_paths(repository_details, rules):
+        rule = get_matching_rule(file_path, rules)
+        if rule and file_path not in files:
+            filename = get_filename(file_path)
+            if filename > last_existing_filenames.get(rule.name, ""):
+                last_existing_filenames[rule.name] = filename
+    return last_existing_filenames
 
-def get_existing_matching_filenames(files, repository_details):
+def can_use_migration_index(commit_details, rules=None):
+    "Copied directories may bring along migrations that are not listed as changes."
+    for copied_file in commit_details.get_copied_files():
+        if copied_file.endswith("/") and may_contain_matching_files(copied_file, rules):
+            return False
+    return True
+
+def may_contain_matching_files(directory, rules=None):
+    return any(rule.may_contain(directory)
+               for rule in with_defaults(rules, DEFAULT_RULES).get_rules(MIGRATION))
+
+def get_existing_file_paths(repository_details, rules=None):
+    if MIGRATION_DISCOVERY == "tree":
+        return repository_details.iter_tree()
+    return get_existing_file_paths_by_module(repository_details, rules)
+
+def get_existing_file_paths_by_module(repository_details, rules=None):
     root_dirs = repository_details.get_files_in(".")
-    all_filenames = []
-    for root_dir in root_dirs:
-        for file_path in repository_details.get_files_in(root_dir + MIGRATION_PATH):
-            if should_check_file(file_path) and file_path not in files:
-                all_filenames.append(get_filename(file_path))
-    return all_filenames
-    
+    migration_dirs = []
+    for rule in with_defaults(rules, DEFAULT_RULES).get_rules(MIGRATION):
+        rule_dirs = rule.get_directories(root_dirs)
+        if rule_dirs is None:
+            return repository_details.iter_tree()
+        migration_dirs.extend(rule_dir for rule_dir in rule_dirs if rule_dir not in migration_dirs)
+    return iter_files_in_directories(repository_details, migration_dirs)
+
+def iter_files_in_directories(repository_details, directories):
+    for file_paths in parallel_map(repository_details.get_files_in, directories):
+        for file_path in file_paths:
+            yield file_path
+
+class MigrationIndex(object):
+    "The existing matching files of a repository revision, per directory."
+
+    def __init__(self, repository, revision, directories=None, rules=None):
+        self.repository = repository
+        self.revision = revision
+        self.rules = with_defaults(rules, DEFAULT_RULES)
+        self._directories = directories if directories is not None else {}
+
+    @classmethod
+    def build(cls, repository_details, revision, rules=None):
+        index = cls(repository_details.get_repository(), revision, rules=rules)
+        for file_path in get_existing_file_paths(repository_details, rules):
+            if should_check_file(file_path, rules):
+                index.add(file_path)
+        return index
+
+    @classmethod
+    def load(cls, index_path, rules=None):
+        "Returns the saved index, or None if it is missing, unreadable or built with other rules."
+        try:
+            index_file = open(index_path)
+            try:
+                data = json.load(index_file)
+            finally:
+                index_file.close()
+            directories = dict((str(directory), [str(filename) for filename in filenames])
+                               for directory, filenames in data["directories"].items())
+            index = cls(str(data["repository"]), data["revision"], directories, rules)
+            if data["rules"] != index.rules.get_fingerprint():
+                return None
+            return index
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, index_path):
+        "Replaces the saved index atomically, so concurrent hooks never read a partial file."
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        handle, temp_path = tempfile.mkstemp(dir=index_dir, prefix=".migration-index-")
+        try:
+            index_file = os.fdopen(handle, "w")
+            try:
+                json.dump({"repository": self.repository,
+                           "revision": self.revision,
+                           "rules": self.rules.get_fingerprint(),
+                           "directories": self._directories}, index_file)
+            finally:
+                index_file.close()
+            os.rename(temp_path, index_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    def copy(self):
+        directories = dict((directory, list(filenames)) for directory, filenames in self._directories.items())
+        return MigrationIndex(self.repository, self.revision, directories, self.rules)
+
+    def add(self, file_path):
+        filenames = self._directories.setdefault(get_file_dir(file_path), [])
+        filename = get_filename(file_path)
+        position = bisect.bisect_left(filenames, filename)
+        if position == len(filenames) or filenames[position] != filename:
+            filenames.insert(position, filename)
+
+    def remove(self, file_path):
+        filenames = self._directories.get(get_file_dir(file_path), [])
+        filename = get_filename(file_path)
+        position = bisect.bisect_left(filenames, filename)
+        if position < len(filenames) and filenames[position] == filename:
+            del filenames[position]
+
+    def remove_directory(self, directory):
+        for indexed_directory in self._directories.keys():
+            if indexed_directory.startswith(directory):
+                del self._directories[indexed_directory]
+
+    def apply_changes(self, revision, changes):
+        "Updates the index with a revision's changes. Returns False if it must be rebuilt instead."
+        for status, file, copied in changes:
+            if file.endswith("/"):
+                if status in ("D", "R"):
+                    self.remove_directory(file)
+                if copied and may_contain_matching_files(file, self.rules):
+                    return False
+            elif should_check_file(file, self.rules):
+                if status == "D":
+                    self.remove(file)
+                else:
+                    self.add(file)
+        self.revision = revision
+        return True
+
+    def get_last_filenames(self, excluded_files=()):
+        "Returns the alphabetically last filename of each rule, ignoring excluded files and directories."
+        excluded_files = set(excluded_files)
+        excluded_directories = [file for file in excluded_files if file.endswith("/")]
+        rule_names = set(rule.name for rule in self.rules.get_rules(MIGRATION))
+        last_filenames = {}
+        for directory, filenames in self._directories.items():
+            if any(directory.startswith(excluded) for excluded in excluded_directories):
+                continue
+            found_rule_names = set()
+            for filename in reversed(filenames):
+                if directory + filename not in excluded_files:
+                    rule = get_matching_rule(directory + filename, self.rules)
+                    if rule and rule.name not in found_rule_names:
+                        found_rule_names.add(rule.name)
+                        if filename > last_filenames.get(rule.name, ""):
+                            last_filenames[rule.name] = filename
+                        if found_rule_names == rule_names:
+                            break
+        return last_filenames
+
+def load_migration_index(index_path, repository_details, rules=None):
+    "Loads the index, first bringing it up to date with the youngest revision."
+    index = MigrationIndex.load(index_path, rules)
+    updated_index = update_migration_index(index, repository_details, rules)
+    if updated_index is not index:
+        try:
+            updated_index.save(index_path)
+        except (IOError, OSError):
+            sys.stderr.write("Warning: Could not save the migration index to \"%s\".\n" % index_path)
+    return updated_index
+
+def update_migration_index(index, repository_details, rules=None):
+    """Returns the index if it is up to date with the youngest revision. Otherwise
+    returns an updated copy, or a rebuilt index if it is missing or too far behind."""
+    repository = repository_details.get_repository()
+    youngest_revision = repository_details.get_youngest_revision()
+    deadline = repository_details.get_deadline()
+    if index is not None and index.repository == repository \
+            and 0 <= youngest_revision - index.revision <= MIGRATION_INDEX_MAX_CATCH_UP:
+        if index.revision == youngest_revision:
+            return index
+        index = index.copy()
+        for revision in range(index.revision + 1, youngest_revision + 1):
+            changes = CommitDetails(repository, revision, test_mode=True, deadline=deadline).get_change_set()
+            if not index.apply_changes(revision, changes):
+                index = None
+                break
+    else:
+        index = None
+    if index is None:
+        youngest_details = RepositoryDetails(repository, youngest_revision, test_mode=True, deadline=deadline)
+        index = MigrationIndex.build(youngest_details, youngest_revision, rules)
+    return index
+
+def add_migration_index_option(parser):
+    parser.add_option("-i", "--migration-index", metavar="FILE",
+                      help="Use and maintain an index of existing files in FILE, " \
+                      "instead of reading the repository tree on every commit.")
+
+def get_migration_index(options, repository_details, rules=None):
+    if options is None or not getattr(options, "migration_index", None):
+        return None
+    return load_migration_index(options.migration_index, repository_details, rules)
 
 def main():
     usage = """Usage: %prog REPOS TXN
@@ -84,9 +340,17 @@ def main():
 Runs pre-commit verification on a repository transaction, verifying that
 matching files are added last, alphabetically."""
     parser = get_option_parser(usage)
+    add_migration_index_option(parser)
+    add_rules_option(parser)
     try:
-        commit_details, repository_details = build_wrappers(parser)
-        return check_filenames(commit_details, repository_details)
+        (options, (repos, transaction_or_revision)) = parser.parse_args()
+        commit_details, repository_details = create_wrappers(options, repos, transaction_or_revision)
+        rules = get_rules(options, repos)
+        load_index = lambda: get_migration_index(options, repository_details, rules)
+        return check_filenames(commit_details, repository_details, rules=rules, migration_index_loader=load_index)
+    except (SvnLookError, RulesError) as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
     except:
         parser.print_help()
         return 1
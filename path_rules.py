@@ -0,0 +1,127 @@
+import os
+import re
+import hashlib
+import ConfigParser
+
+# Rules file, relative to the repository directory. See README.md for the format.
+RULES_FILE = "conf/pre-commit-rules.ini"
+# Python 2 regular expressions are limited to 100 named groups
+MAX_RULES_PER_PATTERN = 99
+
+TAG = "tags"
+MIGRATION = "migrations"
+ASSET = "assets"
+
+class RulesError(Exception):
+    pass
+
+class Rule(object):
+    """Matches files below path, where * matches any single directory, with
+    the rest of the path matching file_pattern."""
+    def __init__(self, kind, name, path, file_pattern=".+"):
+        self.kind = kind
+        self.name = name
+        self.path = path
+        self.file_pattern = file_pattern
+
+    def get_pattern(self):
+        return "[^/]+".join(re.escape(part) for part in self.path.split("*")) + self.file_pattern
+
+    def get_directories(self, root_dirs):
+        "Returns the rule's directory in each root directory, or None if it can not be listed that way."
+        if "*" not in self.path:
+            return [self.path]
+        if self.path.startswith("*/") and "*" not in self.path[2:]:
+            return [root_dir + self.path[2:] for root_dir in root_dirs if root_dir != "/"]
+        return None
+
+    def may_contain(self, directory):
+        "Returns whether matching files may exist in or below the directory."
+        for rule_part, part in zip(self.path.split("/")[:-1], directory.split("/")[:-1]):
+            if rule_part != "*" and rule_part != part:
+                return False
+        return True
+
+class RuleSet(object):
+    """Rules compiled into a single alternation per kind, so that each path is
+    classified against all rules of a kind with one match. The first matching
+    rule wins."""
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._with_defaults = {}
+        self._matchers = {None: self._compile(range(len(self.rules)))}
+        for kind in set(rule.kind for rule in self.rules):
+            self._matchers[kind] = self._compile([index for index, rule in enumerate(self.rules)
+                                                  if rule.kind == kind])
+
+    def _compile(self, indices):
+        matchers = []
+        for start in range(0, len(indices), MAX_RULES_PER_PATTERN):
+            alternatives = ["(?P<r%d>%s)" % (index, self.rules[index].get_pattern())
+                            for index in indices[start:start + MAX_RULES_PER_PATTERN]]
+            matchers.append(re.compile("^(?:%s)" % "|".join(alternatives)))
+        return matchers
+
+    def classify(self, path, kind=None):
+        """Returns the first rule of the kind matching the path, or None. Without
+        a kind, returns the first matching rule of any kind."""
+        for matcher in self._matchers.get(kind, []):
+            match = matcher.match(path)
+            if match:
+                return self.rules[int(match.lastgroup[1:])]
+        return None
+
+    def with_defaults(self, defaults):
+        """Returns these rules followed by the rules of defaults of every kind that
+        these rules do not define, so a rules file without [tags] still protects
+        the default tag paths."""
+        rules = self._with_defaults.get(defaults)
+        if rules is None:
+            missing_rules = [rule for rule in defaults.rules if rule.kind not in self._matchers]
+            rules = RuleSet(self.rules + missing_rules) if missing_rules else self
+            self._with_defaults[defaults] = rules
+        return rules
+
+    def get_rules(self, kind):
+        return [rule for rule in self.rules if rule.kind == kind]
+
+    def get_fingerprint(self):
+        return hashlib.sha1("\n".join("%s %s %s %s" % (rule.kind, rule.name, rule.path, rule.file_pattern)
+                                      for rule in self.rules)).hexdigest()
+
+def with_defaults(rules, defaults):
+    "Returns the rules completed by the defaults of the kinds they do not define, or the defaults without rules."
+    if rules is None:
+        return defaults
+    return rules.with_defaults(defaults)
+
+def load_rules(repository, rules_file=None):
+    "Reads the rules of a repository, or returns None if it has no rules file. Raises RulesError if it is invalid."
+    if rules_file is None:
+        rules_file = os.path.join(repository, RULES_FILE)
+        if not os.path.isfile(rules_file):
+            return None
+    parser = ConfigParser.RawConfigParser()
+    try:
+        if not parser.read(rules_file):
+            raise RulesError("Could not read rules file \"%s\"" % rules_file)
+        rules = []
+        for section in parser.sections():
+            kind = section.split()[0]
+            if kind not in (TAG, MIGRATION, ASSET):
+                raise RulesError("Unknown rule type \"%s\" in \"%s\"" % (kind, rules_file))
+            file_pattern = ".+"
+            if parser.has_option(section, "file_pattern"):
+                file_pattern = parser.get(section, "file_pattern")
+            for path in parser.get(section, "paths").split():
+                rules.append(Rule(kind, section, path, file_pattern))
+        return RuleSet(rules)
+    except (ConfigParser.Error, re.error) as error:
+        raise RulesError("Invalid rules file \"%s\": %s" % (rules_file, error))
+
+def add_rules_option(parser):
+    parser.add_option("--rules", metavar="FILE",
+                      help="Read tag, migration and asset rules from FILE. Default is REPOS/%s, if it exists." % RULES_FILE)
+
+def get_rules(options, repository):
+    return load_rules(repository, getattr(options, "rules", None))
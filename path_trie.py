@@ -0,0 +1,100 @@
+import re
+
+# Key of a node's own slot, next to the components of its children
+SLOT = None
+
+class PathTrie(object):
+    """Paths kept as a tree of interned path components, so that the directories
+    shared by many paths are stored once. Every added path is given a slot, the
+    number of paths added before it, which callers use as the index of the
+    path's record in plain lists. A path ending with "/" ends with an empty
+    component, and a node without children is stored as just its slot. The
+    directory of the last added path is remembered, since listings and
+    changes come grouped by directory."""
+
+    def __init__(self, paths=()):
+        self._root = {}
+        self._size = 0
+        self._last_directory = None
+        self._last_node = None
+        for path in paths:
+            self.add(path)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, path):
+        "Adds the path, returning its slot. A path added again is given a new slot."
+        split = path.rfind("/") + 1
+        directory, last = path[:split], path[split:]
+        if directory == self._last_directory:
+            node = self._last_node
+        else:
+            node = self._root
+            for component in directory.split("/")[:-1]:
+                child = node.get(component)
+                if child is None:
+                    child = node[intern(component)] = {}
+                elif not isinstance(child, dict):
+                    child = node[component] = {SLOT: child}
+                node = child
+            self._last_directory, self._last_node = directory, node
+        slot = self._size
+        child = node.get(last)
+        if isinstance(child, dict):
+            child[SLOT] = slot
+        else:
+            node[intern(last)] = slot
+        self._size += 1
+        return slot
+
+    def get_slot(self, path):
+        "Returns the slot of the path, or None if it was not added."
+        node = self._root
+        for component in path.split("/"):
+            if not isinstance(node, dict):
+                return None
+            node = node.get(component)
+        if isinstance(node, dict):
+            return node.get(SLOT)
+        return node
+
+    def get_under(self, patterns):
+        """Returns the (slot, path) of every path starting with any of the patterns,
+        in slot order. * in a pattern matches any single directory, like in rules."""
+        found = {}
+        for pattern in patterns:
+            components = pattern.split("/")
+            nodes = [("", self._root)]
+            for component in components[:-1]:
+                nodes = [(prefix + name + "/", child) for prefix, node in nodes
+                         for name, child in self._match(node, component, True)
+                         if isinstance(child, dict)]
+            for prefix, node in nodes:
+                for name, child in self._match(node, components[-1], False):
+                    self._collect(prefix + name, child, found)
+        return sorted(found.items())
+
+    def _match(self, node, component, whole):
+        if "*" not in component:
+            if whole:
+                return [(component, node[component])] if component in node else []
+            return [(name, child) for name, child in node.items()
+                    if name is not SLOT and name.startswith(component)]
+        matcher = re.compile("[^/]+".join(re.escape(part) for part in component.split("*"))
+                             + ("$" if whole else ""))
+        return [(name, child) for name, child in node.items()
+                if name and matcher.match(name)]
+
+    def _collect(self, path, node, found):
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            if not isinstance(node, dict):
+                found[node] = path
+                continue
+            for name, child in node.items():
+                if name is SLOT:
+                    found[child] = path
+                else:
+                    stack.append((path + "/" + name, child))
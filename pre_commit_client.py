@@ -0,0 +1,86 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import stat
+import socket
+import optparse
+import tempfile
+
+# Unix socket that pre_commit_daemon.py listens on. Its directory must only be
+# accessible by the user running the hooks, who must also own the socket.
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), "svn-pre-commit-hooks-%d" % os.getuid(), "daemon.sock")
+
+def is_trusted_socket(socket_path):
+    "Returns whether the socket and its directory are owned by this user, and only the user can enter the directory."
+    try:
+        directory_status = os.lstat(os.path.dirname(os.path.abspath(socket_path)))
+        socket_status = os.lstat(socket_path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(directory_status.st_mode) and directory_status.st_uid == os.getuid() and \
+        not directory_status.st_mode & 077 and stat.S_ISSOCK(socket_status.st_mode) and \
+        socket_status.st_uid == os.getuid()
+
+def request_checks(socket_path, request):
+    """Sends a request to the daemon, returning its exit code and error output.
+    Raises socket.error if the socket can not be trusted, and ValueError if the
+    response is invalid."""
+    if not is_trusted_socket(socket_path):
+        raise socket.error("The socket \"%s\" is missing or not private to this user" % socket_path)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request) + "\n")
+        response_file = connection.makefile("r")
+        try:
+            response = json.loads(response_file.readline())
+        finally:
+            response_file.close()
+    finally:
+        connection.close()
+    try:
+        return int(response["exit_code"]), response["stderr"]
+    except (KeyError, TypeError):
+        raise ValueError("Invalid response from the daemon: %r" % response)
+
+def main():
+    usage = """Usage: %prog [options] REPOS TXN
+
+Runs pre-commit verification on a repository transaction by asking
+pre_commit_daemon.py. If the daemon is not running, the checks are run in
+this process instead."""
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-r", "--revision",
+                      help="Test mode. Specify a revision instead of a transaction.",
+                      action="store_true", default=False)
+    parser.add_option("-c", "--check", dest="checks", action="append", metavar="CHECK",
+                      help="Check to run. May be given several times. Defaults to all checks.")
+    parser.add_option("-f", "--fail-fast", action="store_true", default=False,
+                      help="Stop running checks once one has failed.")
+    parser.add_option("-s", "--socket", default=SOCKET_PATH,
+                      help="Socket of the daemon. Default is %s." % SOCKET_PATH)
+    try:
+        (options, (repos, transaction_or_revision)) = parser.parse_args()
+    except:
+        parser.print_help()
+        return 1
+    request = {"repository": repos, "transaction": transaction_or_revision,
+               "revision": options.revision, "checks": options.checks,
+               "fail_fast": options.fail_fast}
+    try:
+        exit_code, errors = request_checks(options.socket, request)
+    except (socket.error, ValueError):
+        import run_pre_commit_checks
+        arguments = ["--revision"] if options.revision else []
+        if options.fail_fast:
+            arguments.append("--fail-fast")
+        for check in options.checks or []:
+            arguments.extend(["--check", check])
+        sys.argv = [sys.argv[0]] + arguments + [repos, transaction_or_revision]
+        return run_pre_commit_checks.main()
+    sys.stderr.write(errors)
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+import os
+import sys
+import json
+import threading
+import SocketServer
+from StringIO import StringIO
+from svn_look_wrappers import get_option_parser, configure, create_deadline, make_private_directory, \
+    CommitDetails, RepositoryDetails, SvnLookError
+from path_rules import add_rules_option, load_rules, with_defaults, RulesError, RULES_FILE
+from ordered_filename_pre_commit import MigrationIndex, update_migration_index, \
+    DEFAULT_RULES as MIGRATION_DEFAULT_RULES
+from run_pre_commit_checks import run_checks, CHECK_NAMES
+from pre_commit_client import SOCKET_PATH
+
+class ThreadLocalStream(object):
+    "Sends what each request thread writes to its own buffer."
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.buffer = StringIO()
+        return self._local.buffer
+
+    def release(self):
+        self._local.buffer = None
+
+    def write(self, text):
+        (getattr(self._local, "buffer", None) or self._default).write(text)
+
+    def flush(self):
+        (getattr(self._local, "buffer", None) or self._default).flush()
+
+class RepositoryCache(object):
+    """Rules and migration indexes of the repositories, kept between commits.
+    Every repository has its own lock, so commits to different repositories
+    never wait for each other."""
+    def __init__(self, rules_file=None, index_directory=None):
+        self._rules_file = rules_file
+        self._index_directory = index_directory
+        self._lock = threading.Lock()
+        self._repository_locks = {}
+        self._rules = {}
+        self._indexes = {}
+
+    def _get_lock(self, repository):
+        with self._lock:
+            return self._repository_locks.setdefault(repository, threading.Lock())
+
+    def get_rules(self, repository):
+        "Returns the repository's rules, reloading them when the rules file has changed."
+        rules_file = self._rules_file or os.path.join(repository, RULES_FILE)
+        try:
+            modified = os.path.getmtime(rules_file)
+        except OSError:
+            modified = None
+        with self._get_lock(repository):
+            cached = self._rules.get(repository)
+            if cached is None or cached[0] != modified:
+                rules = load_rules(repository, self._rules_file) if modified is not None else None
+                cached = (modified, rules)
+                self._rules[repository] = cached
+            return cached[1]
+
+    def get_migration_index(self, repository_details, rules):
+        "Returns the migration index of the youngest revision, updating the cached one."
+        repository = repository_details.get_repository()
+        with self._get_lock(repository):
+            index = self._indexes.get(repository)
+            if index is not None and index.rules.get_fingerprint() != \
+                    with_defaults(rules, MIGRATION_DEFAULT_RULES).get_fingerprint():
+                index = None
+            index_path = self._get_index_path(repository)
+            if index is None and index_path:
+                index = MigrationIndex.load(index_path, rules)
+            updated_index = update_migration_index(index, repository_details, rules)
+            if updated_index is not index and index_path:
+                try:
+                    updated_index.save(index_path)
+                except (IOError, OSError):
+                    pass
+            self._indexes[repository] = updated_index
+            return updated_index
+
+    def get_cached_migration_index(self, repository_details, rules):
+        "Returns the cached migration index as it is, or None if there is none for the rules."
+        repository = repository_details.get_repository()
+        with self._get_lock(repository):
+            index = self._indexes.get(repository)
+        if index is None or index.rules.get_fingerprint() != \
+                with_defaults(rules, MIGRATION_DEFAULT_RULES).get_fingerprint():
+            return None
+        return index
+
+    def _get_index_path(self, repository):
+        if not self._index_directory:
+            return None
+        name = os.path.abspath(repository).strip("/").replace("/", "_")
+        return os.path.join(self._index_directory, name + ".json")
+
+class PreCommitRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if not isinstance(request, dict) or "repository" not in request or "transaction" not in request:
+                raise ValueError("expected a JSON object with a repository and a transaction")
+        except ValueError as error:
+            exit_code, errors = 1, "Error: invalid request to the pre-commit daemon: %s\n" % error
+        else:
+            exit_code, errors = self.server.run_request(request)
+        self.wfile.write(json.dumps({"exit_code": exit_code, "stderr": errors}) + "\n")
+
+class PreCommitDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    "Runs the checks for each connecting client on a thread of its own."
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache, stderr):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, PreCommitRequestHandler)
+        os.chmod(socket_path, 0660)
+        self.cache = cache
+        self.stderr = stderr
+
+    def create_wrappers(self, repository, transaction, test_mode):
+        deadline = create_deadline()
+        return (CommitDetails(repository, transaction, test_mode=test_mode, deadline=deadline),
+                RepositoryDetails(repository, transaction, test_mode=test_mode, deadline=deadline))
+
+    def run_request(self, request):
+        "Runs the requested checks, returning the exit code and what was written to stderr."
+        errors = self.stderr.capture()
+        try:
+            try:
+                repository = request["repository"]
+                checks = request.get("checks") or []
+                unknown_checks = [check for check in checks if check not in CHECK_NAMES]
+                if unknown_checks:
+                    errors.write("Error: Unknown checks: %s. Available checks are %s.\n"
+                                 % (", ".join(unknown_checks), ", ".join(CHECK_NAMES)))
+                    return 1, errors.getvalue()
+                commit_details, repository_details = self.create_wrappers(
+                    repository, request["transaction"], request.get("revision", False))
+                exit_code = run_checks(commit_details, repository_details, checks,
+                                       rules=self.cache.get_rules(repository),
+                                       migration_index_loader=self.cache.get_migration_index,
+                                       fail_fast=request.get("fail_fast", False),
+                                       cached_migration_index_loader=self.cache.get_cached_migration_index)
+            except (SvnLookError, RulesError) as error:
+                errors.write("Error: %s\n" % error)
+                exit_code = 1
+            except Exception as error:
+                errors.write("Error: The pre-commit checks failed: %s\n" % error)
+                exit_code = 1
+            return exit_code, errors.getvalue()
+        finally:
+            self.stderr.release()
+
+def main():
+    usage = """Usage: %prog [options]
+
+Keeps the pre-commit checks resident, answering pre_commit_client.py on a
+local Unix socket."""
+    parser = get_option_parser(usage)
+    parser.remove_option("--revision")
+    add_rules_option(parser)
+    parser.add_option("-s", "--socket", default=SOCKET_PATH,
+                      help="Socket to listen on. Default is %s." % SOCKET_PATH)
+    parser.add_option("--index-directory", metavar="DIR",
+                      help="Also save the migration index of each repository in DIR.")
+    (options, args) = parser.parse_args()
+    configure(options)
+    socket_directory = os.path.dirname(os.path.abspath(options.socket))
+    if not make_private_directory(socket_directory):
+        sys.stderr.write("Error: The socket directory \"%s\" must be a directory only accessible by this user.\n"
+                         % socket_directory)
+        return 1
+    sys.stderr = ThreadLocalStream(sys.stderr)
+    daemon = PreCommitDaemon(options.socket, RepositoryCache(options.rules, options.index_directory),
+                             sys.stderr)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        os.remove(options.socket)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+import sys
+import csv
+import json
+import multiprocessing
+from StringIO import StringIO
+from svn_look_wrappers import get_option_parser, configure, CommitDetails, RepositoryDetails, \
+    SvnLookError
+from path_rules import add_rules_option, load_rules, RulesError
+from ordered_filename_pre_commit import MigrationIndex
+from run_pre_commit_checks import CHECKS, CHECK_NAMES, CheckContext
+
+REPORT_COLUMNS = ["revision", "check", "result", "errors"]
+# The check that uses the migration index
+MIGRATION_CHECK = "ordered-filenames"
+
+_rules = None
+
+def initialize_worker(repository, rules_file):
+    "Loads the rules once per worker."
+    global _rules
+    _rules = load_rules(repository, rules_file)
+
+def split_revisions(first, last, chunk_size):
+    "Splits the revision range into contiguous chunks."
+    return [(start, min(start + chunk_size - 1, last)) for start in range(first, last + 1, chunk_size)]
+
+def replay_chunk(arguments):
+    """Runs the checks on each revision of a chunk in order. When the ordered
+    filename check is selected, the index of existing migrations is built once
+    for the revision before the chunk and then moved forward with the changes
+    of each checked revision."""
+    repository, (first, last), check_names = arguments
+    checks = [check for check in CHECKS if not check_names or check.name in check_names]
+    uses_index = MIGRATION_CHECK in [check.name for check in checks]
+    index = None
+    verdicts = []
+    for revision in range(first, last + 1):
+        commit_details = CommitDetails(repository, revision, test_mode=True)
+        repository_details = RepositoryDetails(repository, revision, test_mode=True)
+        if uses_index and index is None:
+            previous_details = RepositoryDetails(repository, revision - 1, test_mode=True)
+            index = MigrationIndex.build(previous_details, revision - 1, _rules)
+        context = CheckContext(commit_details, repository_details, rules=_rules,
+                               migration_index_loader=lambda repository_details, rules: index)
+        for check in checks:
+            verdicts.append(run_check(revision, check, context))
+        if uses_index and not index.apply_changes(revision, commit_details.get_change_set()):
+            index = None
+    return verdicts
+
+def run_check(revision, check, context):
+    "Runs a check, returning its verdict with what it wrote to stderr."
+    original_stderr = sys.stderr
+    sys.stderr = errors = StringIO()
+    try:
+        try:
+            result = check.run(context)
+        except SvnLookError as error:
+            errors.write("Error: %s\n" % error)
+            result = 1
+    finally:
+        sys.stderr = original_stderr
+    return {"revision": revision, "check": check.name, "result": result, "errors": errors.getvalue()}
+
+def write_report(verdicts, output, report_format):
+    if report_format == "csv":
+        writer = csv.DictWriter(output, REPORT_COLUMNS)
+        writer.writerow(dict((column, column) for column in REPORT_COLUMNS))
+        for verdict in verdicts:
+            writer.writerow(verdict)
+    else:
+        for verdict in verdicts:
+            output.write(json.dumps(verdict, sort_keys=True) + "\n")
+
+def main():
+    usage = """Usage: %prog [options] REPOS FIRST:LAST
+
+Runs the selected checks on every committed revision in the range, writing
+a verdict per revision and check as CSV or JSON lines. Available checks: """ + ", ".join(CHECK_NAMES)
+    parser = get_option_parser(usage)
+    parser.remove_option("--revision")
+    add_rules_option(parser)
+    parser.add_option("-c", "--check", dest="checks", action="append",
+                      choices=CHECK_NAMES, metavar="CHECK",
+                      help="Check to run. May be given several times. Defaults to all checks.")
+    parser.add_option("-p", "--processes", type="int", default=multiprocessing.cpu_count(),
+                      help="Number of worker processes. Default is the number of CPUs.")
+    parser.add_option("--chunk-size", type="int", default=1000,
+                      help="Consecutive revisions replayed by one worker at a time. Default is 1000.")
+    parser.add_option("--format", choices=["csv", "json"], default="csv",
+                      help="Report format: csv or json. Default is csv.")
+    parser.add_option("-o", "--output", metavar="FILE", help="Write the report to FILE instead of stdout.")
+    try:
+        (options, (repos, revision_range)) = parser.parse_args()
+        first, last = [int(revision) for revision in revision_range.split(":")]
+    except:
+        parser.print_help()
+        return 1
+    configure(options)
+    try:
+        load_rules(repos, options.rules)
+    except RulesError as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
+    chunks = [(repos, chunk, options.checks)
+              for chunk in split_revisions(max(first, 1), last, options.chunk_size)]
+    output = open(options.output, "w") if options.output else sys.stdout
+    pool = multiprocessing.Pool(options.processes, initialize_worker, (repos, options.rules))
+    try:
+        verdicts = (verdict for chunk_verdicts in pool.imap(replay_chunk, chunks)
+                    for verdict in chunk_verdicts)
+        write_report(verdicts, output, options.format)
+    finally:
+        pool.terminate()
+        if options.output:
+            output.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
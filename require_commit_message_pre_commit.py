@@ -1,9 +1,10 @@
 #!/usr/bin/python
 import sys
-from svn_look_wrappers import get_option_parser, build_wrappers
+from svn_look_wrappers import get_option_parser, build_wrappers, SvnLookError, timed_check
 
 REQUIRED_COMMIT_MESSAGE_LENGTH = 3
 
+@timed_check("commit-message")
 def check_commit_message(commit_details):
     if len(commit_details.get_commit_message()) < REQUIRED_COMMIT_MESSAGE_LENGTH:
         sys.stderr.write("Error: Please enter a descriptive commit message!\n")
@@ -19,6 +20,9 @@ the commit message is descriptive."""
     try:
         commit_details, repository_details = build_wrappers(parser)
         return check_commit_message(commit_details)
+    except SvnLookError as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
     except:
         parser.print_help()
         return 1
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+import sys
+from svn_look_wrappers import get_option_parser, create_wrappers, record_timing, \
+    SvnLookError, DeadlineExceeded
+from require_commit_message_pre_commit import check_commit_message
+from no_changes_in_tags_pre_commit import fail_on_tag_changes, SKIP_KEYWORD as TAG_SKIP_KEYWORD
+from ordered_filename_pre_commit import check_filenames, add_migration_index_option, \
+    get_migration_index, MigrationIndex, SKIP_KEYWORD as MIGRATION_SKIP_KEYWORD
+from no_large_or_binary_files_pre_commit import check_files, SKIP_KEYWORD as FILE_SKIP_KEYWORD
+from path_rules import add_rules_option, get_rules, RulesError
+
+# Data a check may need, with the relative cost of fetching it. The changed
+# paths and their copy info come from the same svnlook call, while the
+# contents take svnlook calls per changed file.
+LOG = "log"
+CHANGES = "changes"
+COPY_INFO = "copy-info"
+TREE = "tree"
+CONTENTS = "contents"
+DATA_COSTS = {LOG: 1, CHANGES: 2, COPY_INFO: 2, TREE: 3, CONTENTS: 4}
+
+# What happens to a check that can not finish before the commit deadline.
+# "fail-closed" rejects the commit, "fail-open" accepts it with a warning and
+# "cached" answers from cached data, such as a stale migration index, and
+# fails closed when there is none.
+FAIL_CLOSED = "fail-closed"
+FAIL_OPEN = "fail-open"
+CACHED = "cached"
+DEGRADE_POLICIES = [FAIL_CLOSED, FAIL_OPEN, CACHED]
+
+class Check(object):
+    """A check, the data it needs, the keyword that skips it and what happens
+    when it can not finish before the deadline. run_cached answers from cached
+    data only, returning None when there is none."""
+    def __init__(self, name, run, needs, skip_keyword=None, degrade_policy=FAIL_CLOSED, run_cached=None):
+        self.name = name
+        self.run = run
+        self.needs = needs
+        self.skip_keyword = skip_keyword
+        self.degrade_policy = degrade_policy
+        self.run_cached = run_cached
+
+    def get_cost(self):
+        return max(DATA_COSTS[data] for data in self.needs)
+
+    def is_skipped(self, commit_message):
+        return self.skip_keyword is not None and self.skip_keyword in commit_message.split()
+
+# Available checks. They are run cheapest first.
+CHECKS = [
+    Check("commit-message", lambda context:
+              check_commit_message(context.commit_details),
+          [LOG]),
+    Check("no-tag-changes", lambda context:
+              fail_on_tag_changes(context.commit_details, context.rules),
+          [LOG, CHANGES, COPY_INFO], TAG_SKIP_KEYWORD),
+    Check("ordered-filenames", lambda context:
+              check_filenames(context.commit_details, context.repository_details, rules=context.rules,
+                              migration_index_loader=context.get_migration_index),
+          [LOG, CHANGES, COPY_INFO, TREE], MIGRATION_SKIP_KEYWORD, CACHED,
+          lambda context: check_filenames_from_cache(context)),
+    Check("no-large-or-binary-files", lambda context:
+              check_files(context.commit_details, context.rules),
+          [LOG, CHANGES, CONTENTS], FILE_SKIP_KEYWORD, FAIL_OPEN),
+]
+CHECK_NAMES = [check.name for check in CHECKS]
+
+class CheckContext(object):
+    "What the checks of a commit share."
+    def __init__(self, commit_details, repository_details, options=None, rules=None,
+                 migration_index_loader=None, cached_migration_index_loader=None):
+        self.commit_details = commit_details
+        self.repository_details = repository_details
+        self.options = options
+        self.rules = rules
+        self._migration_index_loader = migration_index_loader
+        self._cached_migration_index_loader = cached_migration_index_loader
+
+    def get_migration_index(self):
+        if self._migration_index_loader is not None:
+            return self._migration_index_loader(self.repository_details, self.rules)
+        return get_migration_index(self.options, self.repository_details, self.rules)
+
+    def get_cached_migration_index(self):
+        "Returns the migration index as last saved, without bringing it up to date, or None."
+        if self._cached_migration_index_loader is not None:
+            return self._cached_migration_index_loader(self.repository_details, self.rules)
+        if self.options is not None and getattr(self.options, "migration_index", None):
+            return MigrationIndex.load(self.options.migration_index, self.rules)
+        return None
+
+def check_filenames_from_cache(context):
+    migration_index = context.get_cached_migration_index()
+    if migration_index is None:
+        return None
+    return check_filenames(context.commit_details, context.repository_details, migration_index, context.rules)
+
+def run_checks(commit_details, repository_details, enabled_checks=None, options=None, rules=None,
+               migration_index_loader=None, fail_fast=False, degrade_policies=None,
+               cached_migration_index_loader=None):
+    """Runs the enabled checks against shared wrappers, returning the number of failed checks.
+
+    Checks skipped by a keyword in the commit message are dropped before any other
+    data is fetched. The rest run cheapest first, each fetching what it needs through
+    the shared wrappers. With fail_fast, no further checks run once one has failed.
+    Checks that can not finish before the deadline of the wrappers are degraded by
+    their policy, which degrade_policies may override by check name, and are listed
+    at the end."""
+    context = CheckContext(commit_details, repository_details, options, rules, migration_index_loader,
+                           cached_migration_index_loader)
+    deadline = commit_details.get_deadline()
+    checks = [check for check in CHECKS if not enabled_checks or check.name in enabled_checks]
+    commit_message = commit_details.get_commit_message()
+    checks = [check for check in checks if not check.is_skipped(commit_message)]
+    checks.sort(key=lambda check: check.get_cost())
+    failed_checks = 0
+    degraded_checks = []
+    for check in checks:
+        try:
+            if deadline is not None:
+                deadline.require(0, "the check \"%s\"" % check.name)
+            result = check.run(context)
+        except DeadlineExceeded:
+            policy = (degrade_policies or {}).get(check.name, check.degrade_policy)
+            result, policy = degrade(check, policy, context)
+            degraded_checks.append("%s (%s)" % (check.name, policy))
+        if result:
+            failed_checks += 1
+            if fail_fast:
+                break
+    if degraded_checks:
+        sys.stderr.write("Degraded checks: %s\n" % ", ".join(degraded_checks))
+    return failed_checks
+
+def degrade(check, policy, context):
+    "Returns the result of a check that could not finish before the deadline, with the policy applied."
+    result = None
+    if policy == CACHED and check.run_cached is not None:
+        try:
+            result = check.run_cached(context)
+        except DeadlineExceeded:
+            pass
+    if result is not None:
+        sys.stderr.write("Warning: The check \"%s\" used cached data, since it could not finish " \
+                         "before the deadline.\n" % check.name)
+    elif policy == FAIL_OPEN:
+        sys.stderr.write("Warning: The check \"%s\" was skipped, since it could not finish " \
+                         "before the deadline.\n" % check.name)
+        result = 0
+    else:
+        sys.stderr.write("Error: The check \"%s\" could not finish before the deadline.\n" % check.name)
+        policy = FAIL_CLOSED
+        result = 1
+    record_timing({"type": "degraded", "check": check.name, "policy": policy, "result": result})
+    return result, policy
+
+def parse_degrade_policies(values):
+    "Parses CHECK=POLICY values of the --degrade option."
+    policies = {}
+    for value in values or []:
+        name, policy = value.split("=", 1)
+        if name not in CHECK_NAMES or policy not in DEGRADE_POLICIES:
+            raise ValueError("Invalid degrade policy \"%s\"" % value)
+        policies[name] = policy
+    return policies
+
+def main():
+    usage = """Usage: %prog [options] REPOS TXN
+
+Runs all enabled pre-commit verifications on a repository transaction in a
+single process, cheapest first. Available checks: """ + ", ".join(CHECK_NAMES)
+    parser = get_option_parser(usage)
+    parser.add_option("-c", "--check", dest="checks", action="append",
+                      choices=CHECK_NAMES, metavar="CHECK",
+                      help="Check to run. May be given several times. Defaults to all checks.")
+    parser.add_option("-f", "--fail-fast", action="store_true", default=False,
+                      help="Stop running checks once one has failed.")
+    parser.add_option("--degrade", action="append", metavar="CHECK=POLICY",
+                      help="What happens to CHECK when it can not finish before the deadline: " \
+                      "%s. May be given several times." % ", ".join(DEGRADE_POLICIES))
+    add_migration_index_option(parser)
+    add_rules_option(parser)
+    try:
+        (options, (repos, transaction_or_revision)) = parser.parse_args()
+        degrade_policies = parse_degrade_policies(options.degrade)
+        commit_details, repository_details = create_wrappers(options, repos, transaction_or_revision)
+        rules = get_rules(options, repos)
+        return run_checks(commit_details, repository_details, options.checks, options, rules,
+                          fail_fast=options.fail_fast, degrade_policies=degrade_policies)
+    except (SvnLookError, RulesError) as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
+    except:
+        parser.print_help()
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,63 +1,766 @@
 import subprocess
 import os
+import sys
 import optparse
+import threading
+import Queue
+import time
+import json
+import functools
+import contextlib
+import re
+import stat
+import errno
+import atexit
+import hashlib
+import tempfile
+from path_trie import PathTrie
+from tree_snapshot import TreeSnapshot, TreeSnapshotBackend
+try:
+    from svn import core as svn_core, fs as svn_fs, repos as svn_repos
+except ImportError:
+    svn_core = svn_fs = svn_repos = None
 
 # Path to svnlook executable
 SVNLOOK_COMMAND = "svnlook"
+# How the repository is queried. "svnlook" runs the svnlook executable,
+# "bindings" uses the Subversion Python bindings in-process and "auto" uses
+# the bindings when they are installed.
+SVNLOOK_BACKEND = "auto"
+# Maximum number of independent svnlook queries run at the same time
+SVNLOOK_JOBS = 4
+# Print each svnlook command to standard output before running it
+SVNLOOK_DEBUG = False
+# Seconds before an svnlook query is aborted, or None to wait indefinitely
+SVNLOOK_TIMEOUT = None
+# Seconds that all queries and checks of a commit may take together, or None
+# for no deadline. Checks that can not finish in time are degraded.
+COMMIT_DEADLINE = None
+# File that timings of svnlook queries and checks are appended to as JSON
+# lines, "-" for standard error, or None to not record timings
+TIMINGS_FILE = None
+# Private directory where the svnlook results of a transaction are kept for the
+# other hook scripts of the same commit, or None to not share them. Only worth it
+# when the checks run as separate scripts.
+SNAPSHOT_DIRECTORY = None
+# Directory used for snapshots by --snapshot
+DEFAULT_SNAPSHOT_DIRECTORY = os.path.join(tempfile.gettempdir(), "svn-pre-commit-snapshots-%d" % os.getuid())
+# Snapshots are removed when their transaction is finished, or after this many seconds
+SNAPSHOT_MAX_AGE = 3600
+# Results longer than this many lines, like large tree listings, are not kept in snapshots
+SNAPSHOT_MAX_LINES = 100000
+# Directory with the sorted path snapshots of each revision written by
+# tree_snapshot_post_commit.py, or None to list the repository tree with svnlook
+TREE_SNAPSHOT_DIRECTORY = None
+
+class SvnLookError(Exception):
+    pass
+
+class SvnLookTimeout(SvnLookError):
+    pass
+
+class DeadlineExceeded(SvnLookTimeout):
+    pass
+
+class Deadline(object):
+    "The time by which all queries and checks of a commit must be done."
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._end = time.time() + seconds
+
+    def get_remaining(self):
+        return self._end - time.time()
+
+    def is_expired(self):
+        return self.get_remaining() <= 0
+
+    def require(self, seconds, step):
+        "Raises DeadlineExceeded unless at least seconds are left for the step."
+        if self.get_remaining() < seconds:
+            raise DeadlineExceeded("Not enough time left before the deadline of %s seconds for %s"
+                                   % (self.seconds, step))
+
+    def get_timeout(self, timeout=None):
+        "Returns the timeout shortened to the time left, raising DeadlineExceeded if none is left."
+        self.require(0, "another svnlook query")
+        return min(timeout or self.get_remaining(), self.get_remaining())
 
 def get_option_parser(usage):
     parser = optparse.OptionParser(usage=usage)
     parser.add_option("-r", "--revision",
                       help="Test mode. Specify a revision instead of a transaction.",
                       action="store_true", default=False)
+    parser.add_option("-b", "--backend", choices=["auto"] + sorted(BACKENDS.keys()),
+                      help="How to query the repository: auto, bindings or svnlook. Default is %s." % SVNLOOK_BACKEND)
+    parser.add_option("-j", "--jobs", type="int",
+                      help="Maximum number of svnlook queries to run at the same time. Default is %d." % SVNLOOK_JOBS)
+    parser.add_option("-t", "--timeout", type="float",
+                      help="Seconds before an svnlook query is aborted. Default is no timeout.")
+    parser.add_option("-d", "--deadline", type="float",
+                      help="Seconds that all queries and checks of the commit may take. Default is no deadline.")
+    parser.add_option("--timings", metavar="FILE",
+                      help="Append timings of svnlook queries and checks to FILE as JSON lines. " \
+                      "Use - for standard error.")
+    parser.add_option("--snapshot", action="store_true", default=False,
+                      help="Share the svnlook results of a transaction with the other hook scripts " \
+                      "of the commit through %s." % DEFAULT_SNAPSHOT_DIRECTORY)
+    parser.add_option("--snapshot-dir", metavar="DIR",
+                      help="Share the svnlook results of a transaction with the other hook scripts " \
+                      "of the commit through DIR.")
+    parser.add_option("--tree-snapshot", metavar="DIR",
+                      help="Answer tree listings from the snapshot of the youngest revision in DIR, " \
+                      "written by tree_snapshot_post_commit.py, when there is one.")
     return parser
 
 def build_wrappers(option_parser):
     (options, (repos, transaction_or_revision)) = option_parser.parse_args()
-    commit_details = CommitDetails(repos, transaction_or_revision, test_mode=options.revision)
-    repository_details = RepositoryDetails(repos, transaction_or_revision, test_mode=options.revision)
+    return create_wrappers(options, repos, transaction_or_revision)
+
+def create_wrappers(options, repos, transaction_or_revision):
+    configure(options)
+    snapshot = None
+    if SNAPSHOT_DIRECTORY and not options.revision:
+        snapshot = TransactionSnapshot.open(repos, transaction_or_revision)
+    deadline = create_deadline()
+    commit_details = CommitDetails(repos, transaction_or_revision, test_mode=options.revision,
+                                   snapshot=snapshot, deadline=deadline)
+    repository_details = RepositoryDetails(repos, transaction_or_revision, test_mode=options.revision,
+                                           snapshot=snapshot, deadline=deadline)
+    if TREE_SNAPSHOT_DIRECTORY:
+        repository_details.use_tree_snapshot(TREE_SNAPSHOT_DIRECTORY, commit_details)
     return commit_details, repository_details
 
-def command_output(cmd):
-  "Captures a command's standard output."
-  dev_null = open(os.devnull, "w")
-  result = []
-  try:
-    result = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=dev_null).communicate()[0].split("\n")
-  finally:
-    dev_null.close()
-  return result
+def create_deadline():
+    "Starts the configured deadline of a commit, if any."
+    if COMMIT_DEADLINE:
+        return Deadline(COMMIT_DEADLINE)
+    return None
+
+def configure(options):
+    "Applies the command line options to the module settings."
+    global SVNLOOK_BACKEND, SVNLOOK_JOBS, SVNLOOK_TIMEOUT, COMMIT_DEADLINE, TIMINGS_FILE, SNAPSHOT_DIRECTORY, \
+        TREE_SNAPSHOT_DIRECTORY
+    if getattr(options, "backend", None):
+        SVNLOOK_BACKEND = options.backend
+    if getattr(options, "jobs", None):
+        SVNLOOK_JOBS = options.jobs
+    if getattr(options, "timeout", None):
+        SVNLOOK_TIMEOUT = options.timeout
+    if getattr(options, "deadline", None):
+        COMMIT_DEADLINE = options.deadline
+    if getattr(options, "timings", None):
+        TIMINGS_FILE = options.timings
+    if getattr(options, "snapshot", False):
+        SNAPSHOT_DIRECTORY = DEFAULT_SNAPSHOT_DIRECTORY
+    if getattr(options, "snapshot_dir", None):
+        SNAPSHOT_DIRECTORY = options.snapshot_dir
+    if getattr(options, "tree_snapshot", None):
+        TREE_SNAPSHOT_DIRECTORY = options.tree_snapshot
+
+_timings_lock = threading.Lock()
+
+def record_timing(record):
+    "Writes a timing record to TIMINGS_FILE as a JSON line."
+    if TIMINGS_FILE is None:
+        return
+    record["time"] = time.time()
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _timings_lock:
+        if TIMINGS_FILE == "-":
+            sys.stderr.write(line)
+        else:
+            timings_file = open(TIMINGS_FILE, "a")
+            try:
+                timings_file.write(line)
+            finally:
+                timings_file.close()
+
+def timed_check(name):
+    "Decorates a check function to record its total run time."
+    def decorate(check):
+        @functools.wraps(check)
+        def timed(*args, **kwargs):
+            if TIMINGS_FILE is None:
+                return check(*args, **kwargs)
+            started = time.time()
+            result = None
+            try:
+                result = check(*args, **kwargs)
+                return result
+            finally:
+                record_timing({"type": "check", "check": name, "result": result,
+                               "seconds": time.time() - started})
+        return timed
+    return decorate
+
+def parallel_map(function, items, jobs=None):
+    "Calls function for every item on at most jobs threads, returning the results in order."
+    items = list(items)
+    jobs = min(jobs or SVNLOOK_JOBS, len(items))
+    if jobs <= 1:
+        return [function(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    indices = Queue.Queue()
+    for index in range(len(items)):
+        indices.put(index)
+    def work():
+        while not errors:
+            try:
+                index = indices.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(items[index])
+            except:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=work) for i in range(jobs)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+@contextlib.contextmanager
+def open_command(cmd, timeout=None):
+    """Starts a command, given as a list of arguments, and yields its process. The command
+    is killed after timeout seconds, and stopped if it is still running when the block is left."""
+    dev_null = open(os.devnull, "w")
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=dev_null)
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            try:
+                process.kill()
+            except OSError:
+                pass
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            yield process
+            if timed_out:
+                raise SvnLookTimeout("\"%s\" did not finish within %s seconds" % (" ".join(cmd), timeout))
+        finally:
+            if timer:
+                timer.cancel()
+            process.stdout.close()
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+    finally:
+        dev_null.close()
+
+def iter_command_output(cmd, timeout=None):
+    "Yields a command's standard output line by line, as it is produced."
+    with open_command(cmd, timeout) as process:
+        for line in process.stdout:
+            yield line.rstrip("\n")
+
+def read_command_output(cmd, size, timeout=None):
+    "Reads at most size bytes of a command's standard output, stopping the command after that."
+    with open_command(cmd, timeout) as process:
+        return process.stdout.read(size)
+
+def command_output(cmd, timeout=None):
+    "Captures a command's standard output."
+    return list(iter_command_output(cmd, timeout))
+
+class SvnLookBackend(object):
+    "Answers queries by running the svnlook executable."
+    def __init__(self, repository, transaction, test_mode=False, deadline=None):
+        self._repository = repository
+        self._transaction = transaction
+        self._test_mode = test_mode
+        self._deadline = deadline
+
+    def youngest(self):
+        return int(list(self._iter_output([SVNLOOK_COMMAND, "youngest", self._repository]))[0])
+
+    def _get_look_command(self, command, args=None):
+        "Returns the svnlook arguments of a query. The path in args is passed as a single argument."
+        look_option = "--revision" if self._test_mode else "--transaction"
+        look_command = [SVNLOOK_COMMAND] + command.split() + [self._repository, look_option, str(self._transaction)]
+        if args:
+            look_command.append(args)
+        return look_command
+
+    def iter_look(self, command, args=None):
+        "Yields a command's standard output line by line, as it is produced."
+        look_command = self._get_look_command(command, args)
+        if SVNLOOK_DEBUG:
+            print "[debug]$ %s" % " ".join(look_command)
+        return self._iter_output(look_command)
+
+    def look(self, command, args=None):
+        "Captures a command's standard output."
+        return list(self.iter_look(command, args))
+
+    def read(self, command, args, size):
+        "Reads at most size bytes of a command's standard output."
+        look_command = self._get_look_command(command, args)
+        if SVNLOOK_DEBUG:
+            print "[debug]$ %s" % " ".join(look_command)
+        try:
+            return read_command_output(look_command, size, self._get_timeout())
+        except SvnLookTimeout:
+            self._check_deadline(look_command)
+            raise
+
+    def _iter_output(self, cmd):
+        try:
+            for line in iter_command_output(cmd, self._get_timeout()):
+                yield line
+        except SvnLookTimeout:
+            self._check_deadline(cmd)
+            raise
+
+    def _get_timeout(self):
+        if self._deadline is None:
+            return SVNLOOK_TIMEOUT
+        return self._deadline.get_timeout(SVNLOOK_TIMEOUT)
+
+    def _check_deadline(self, cmd):
+        "Tells a query aborted by the deadline from one that exceeded the svnlook timeout."
+        if self._deadline is not None:
+            self._deadline.require(0, "\"%s\"" % " ".join(cmd))
+
+def format_change(status, file, copied, copied_from=None):
+    "Formats a change the way 'svnlook changed --copy-info' prints it."
+    lines = ["%-2s%s %s" % (status, "+" if copied else " ", file)]
+    if copied and copied_from:
+        lines.append("    (from %s:r%d)" % copied_from)
+    return lines
+
+# The bindings allocate from pools that are not thread-safe, including a global
+# one, so all calls into them are made one at a time
+_bindings_lock = threading.RLock()
+
+class BindingsBackend(object):
+    """Answers queries in-process through the Subversion Python bindings,
+    producing the same output as svnlook. Other queries are passed on to svnlook.
+    Calls into the bindings hold _bindings_lock, so threads take turns."""
+    def __init__(self, repository, transaction, test_mode=False, deadline=None):
+        self._fallback = SvnLookBackend(repository, transaction, test_mode, deadline)
+        self._deadline = deadline
+        with _bindings_lock:
+            self._fs = svn_repos.fs(svn_repos.open(svn_core.svn_path_canonicalize(os.path.abspath(repository))))
+            if test_mode:
+                revision = int(transaction)
+                self._root = svn_fs.revision_root(self._fs, revision)
+                self._base_revision = revision - 1
+                self._log = svn_fs.revision_prop(self._fs, revision, svn_core.SVN_PROP_REVISION_LOG)
+            else:
+                txn = svn_fs.open_txn(self._fs, transaction)
+                self._root = svn_fs.txn_root(txn)
+                self._base_revision = svn_fs.txn_base_revision(txn)
+                self._log = svn_fs.txn_prop(txn, svn_core.SVN_PROP_REVISION_LOG)
+
+    def youngest(self):
+        with _bindings_lock:
+            return svn_fs.youngest_rev(self._fs)
+
+    def iter_look(self, command, args=None):
+        if self._deadline is not None:
+            self._deadline.require(0, "\"%s\"" % command)
+        words = command.split()
+        if words[0] == "changed":
+            return self._changed()
+        if words[0] == "log":
+            return self._log_lines()
+        if words[0] == "tree" and "--full-paths" in words:
+            return self._tree(args, "--non-recursive" not in words)
+        if words[0] == "filesize":
+            with _bindings_lock:
+                return [str(svn_fs.file_length(self._root, "/" + args.lstrip("/")))]
+        return self._fallback.iter_look(command, args)
+
+    def look(self, command, args=None):
+        return list(self.iter_look(command, args))
+
+    def read(self, command, args, size):
+        if command == "cat":
+            with _bindings_lock:
+                stream = svn_fs.file_contents(self._root, "/" + args.lstrip("/"))
+                try:
+                    return svn_core.svn_stream_read(stream, size)
+                finally:
+                    svn_core.svn_stream_close(stream)
+        return self._fallback.read(command, args, size)
+
+    def _log_lines(self):
+        if not self._log:
+            return []
+        return self._log.split("\n")
+
+    def _changed(self):
+        lines = []
+        with _bindings_lock:
+            changes = svn_fs.paths_changed2(self._root)
+            for path in sorted(changes):
+                change = changes[path]
+                file = path.lstrip("/")
+                if self._is_directory(path, change):
+                    file += "/"
+                status = self._get_status(change)
+                copied_from = None
+                if change.change_kind in (svn_fs.path_change_add, svn_fs.path_change_replace):
+                    copied_from_revision, copied_from_path = svn_fs.copied_from(self._root, path)
+                    if copied_from_revision >= 0:
+                        copied_from = (copied_from_path.lstrip("/"), copied_from_revision)
+                lines.extend(format_change(status, file, copied_from is not None, copied_from))
+        return lines
+
+    def _get_status(self, change):
+        property_status = "U" if change.prop_mod else " "
+        if change.change_kind == svn_fs.path_change_add:
+            return "A" + property_status
+        if change.change_kind == svn_fs.path_change_delete:
+            return "D "
+        if change.change_kind == svn_fs.path_change_replace:
+            return "R" + property_status
+        return ("U" if change.text_mod else "_") + property_status
+
+    def _is_directory(self, path, change):
+        if change.node_kind == svn_core.svn_node_dir:
+            return True
+        if change.change_kind == svn_fs.path_change_delete and change.node_kind != svn_core.svn_node_file:
+            base_root = svn_fs.revision_root(self._fs, self._base_revision)
+            return svn_fs.check_path(base_root, path) == svn_core.svn_node_dir
+        return False
+
+    def _tree(self, directory, recursive):
+        path = (directory or "").strip("/")
+        path = "/" if path in ("", ".") else "/" + path
+        with _bindings_lock:
+            kind = svn_fs.check_path(self._root, path)
+        if kind == svn_core.svn_node_dir:
+            return self._walk_directory(path, recursive, time.time())
+        if kind == svn_core.svn_node_file:
+            return [path.lstrip("/")]
+        return []
+
+    def _walk_directory(self, path, recursive, started):
+        self._check_time("listing \"%s\"" % path, started)
+        yield "/" if path == "/" else path.lstrip("/") + "/"
+        with _bindings_lock:
+            entries = dict((name, entry.kind) for name, entry in svn_fs.dir_entries(self._root, path).items())
+        for name in sorted(entries):
+            entry_path = path.rstrip("/") + "/" + name
+            if entries[name] == svn_core.svn_node_dir:
+                if recursive:
+                    for line in self._walk_directory(entry_path, recursive, started):
+                        yield line
+                else:
+                    yield entry_path.lstrip("/") + "/"
+            else:
+                yield entry_path.lstrip("/")
+
+    def _check_time(self, step, started):
+        "Stops a query that has run past the deadline or SVNLOOK_TIMEOUT, like svnlook is stopped."
+        if self._deadline is not None:
+            self._deadline.require(0, step)
+        if SVNLOOK_TIMEOUT and time.time() - started > SVNLOOK_TIMEOUT:
+            raise SvnLookTimeout("%s did not finish within %s seconds" % (step, SVNLOOK_TIMEOUT))
+
+BACKENDS = {
+    "svnlook": SvnLookBackend,
+    "bindings": BindingsBackend,
+}
+
+def create_backend(repository, transaction, test_mode=False, backend=None, deadline=None):
+    "Creates the configured backend. \"auto\" uses the bindings when they are importable."
+    backend = backend or SVNLOOK_BACKEND
+    if backend == "auto":
+        backend = "bindings" if svn_core is not None else "svnlook"
+    if backend == "bindings" and svn_core is None:
+        raise ImportError("The Subversion Python bindings are not available")
+    return BACKENDS[backend](repository, transaction, test_mode, deadline)
+
+def make_private_directory(directory):
+    "Creates the directory if needed. Returns whether it is a directory only accessible by this user."
+    try:
+        os.mkdir(directory, 0700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            return False
+    status = os.lstat(directory)
+    return stat.S_ISDIR(status.st_mode) and status.st_uid == os.getuid() and not status.st_mode & 077
+
+def get_transaction_directory(repository, transaction):
+    "Returns the directory of a transaction in an FSFS repository."
+    return os.path.join(repository, "db", "transactions", "%s.txn" % transaction)
+
+def is_transaction_finished(repository, transaction):
+    "Returns whether the transaction was committed or aborted, as far as can be told from its directory."
+    if not os.path.isdir(os.path.join(repository, "db", "transactions")):
+        return False
+    return not os.path.isdir(get_transaction_directory(repository, transaction))
+
+def get_transaction_identity(repository, transaction):
+    "Tells a transaction from an earlier one of the same name, where the repository allows."
+    try:
+        return os.stat(get_transaction_directory(repository, transaction)).st_ino
+    except OSError:
+        return None
+
+class TransactionSnapshot(object):
+    """The svnlook results of a transaction, saved in a private directory so that
+    the other hook scripts of the same commit load them instead of running
+    svnlook again. Results are saved when the process exits, by replacing the
+    file atomically with the saved results merged with the new ones."""
+    def __init__(self, path, repository, transaction):
+        self._path = path
+        self._repository = os.path.abspath(repository)
+        self._transaction = str(transaction)
+        self._identity = get_transaction_identity(repository, transaction)
+        self._lock = threading.Lock()
+        self._results = self._load()
+        self._new_results = {}
+
+    @classmethod
+    def open(cls, repository, transaction, directory=None):
+        "Returns the snapshot of the transaction, or None if the snapshot directory can not be trusted."
+        directory = directory or SNAPSHOT_DIRECTORY
+        if not make_private_directory(directory):
+            return None
+        repository_key = hashlib.sha1(os.path.abspath(repository)).hexdigest()
+        remove_stale_snapshots(directory, repository, repository_key)
+        name = str(transaction)
+        if not re.match(r"^[\w.-]+$", name):
+            name = hashlib.sha1(name).hexdigest()
+        snapshot = cls(os.path.join(directory, "%s-%s.json" % (repository_key, name)), repository, transaction)
+        atexit.register(snapshot.save)
+        return snapshot
+
+    def get(self, command, args):
+        "Returns the saved output of a query, or None."
+        with self._lock:
+            return self._results.get(self._get_key(command, args))
+
+    def put(self, command, args, lines):
+        with self._lock:
+            key = self._get_key(command, args)
+            self._results[key] = self._new_results[key] = lines
+
+    def save(self):
+        "Adds the new results to the saved snapshot. Failures are ignored, as the snapshot is only a cache."
+        with self._lock:
+            if not self._new_results:
+                return
+            results = self._load()
+            results.update(self._new_results)
+            directory = os.path.dirname(self._path)
+            try:
+                handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+            except OSError:
+                return
+            try:
+                snapshot_file = os.fdopen(handle, "w")
+                try:
+                    json.dump({"repository": self._repository, "transaction": self._transaction,
+                               "identity": self._identity, "results": results}, snapshot_file)
+                finally:
+                    snapshot_file.close()
+                os.rename(temp_path, self._path)
+                self._new_results = {}
+            except (IOError, OSError, ValueError, UnicodeDecodeError):
+                os.remove(temp_path)
+
+    def _load(self):
+        try:
+            snapshot_file = open(self._path)
+            try:
+                data = json.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+            if (data["repository"], data["transaction"], data["identity"]) != \
+                    (self._repository, self._transaction, self._identity):
+                return {}
+            return dict((key.encode("utf-8"), [line.encode("utf-8") for line in lines])
+                        for key, lines in data["results"].items())
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+
+    def _get_key(self, command, args):
+        return "%s %s" % (command, args or "")
+
+def remove_stale_snapshots(directory, repository, repository_key):
+    "Removes the snapshots of finished transactions of the repository, and all expired snapshots."
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - os.stat(path).st_mtime > SNAPSHOT_MAX_AGE:
+                os.remove(path)
+            elif name.startswith(repository_key + "-") and name.endswith(".json") and \
+                    is_transaction_finished(repository, name[len(repository_key) + 1:-len(".json")]):
+                os.remove(path)
+        except OSError:
+            pass
+
+class SnapshotBackend(object):
+    "Answers queries from a TransactionSnapshot, adding the results of other queries to it."
+    def __init__(self, backend, snapshot):
+        self._backend = backend
+        self._snapshot = snapshot
+
+    def youngest(self):
+        return self._backend.youngest()
+
+    def iter_look(self, command, args=None):
+        lines = self._snapshot.get(command, args)
+        if lines is not None:
+            return iter(lines)
+        return self._iter_and_keep(command, args)
+
+    def look(self, command, args=None):
+        return list(self.iter_look(command, args))
+
+    def read(self, command, args, size):
+        return self._backend.read(command, args, size)
+
+    def _iter_and_keep(self, command, args):
+        "Yields the backend's output, keeping it in the snapshot if it is read to the end."
+        lines = []
+        for line in self._backend.iter_look(command, args):
+            if lines is not None:
+                lines.append(line)
+                if len(lines) > SNAPSHOT_MAX_LINES:
+                    lines = None
+            yield line
+        if lines is not None:
+            self._snapshot.put(command, args, lines)
 
 class SvnLookWrapper(object):
-    def __init__(self, repository, transaction, test_mode=False):
+    def __init__(self, repository, transaction, test_mode=False, backend=None, snapshot=None, deadline=None):
         self._repository = repository
         self._transaction = transaction
         self._test_mode = test_mode
-        pass
-    
+        self._deadline = deadline
+        self._backend = create_backend(repository, transaction, test_mode, backend, deadline)
+        if snapshot is not None:
+            self._backend = SnapshotBackend(self._backend, snapshot)
+
+    def get_repository(self):
+        return self._repository
+
+    def get_deadline(self):
+        return self._deadline
+
+    def get_youngest_revision(self):
+        "Returns the youngest revision of the repository, regardless of transaction."
+        return self._backend.youngest()
+
+    def _iter_svn_look(self, command, args=None):
+        "Yields a command's standard output line by line, as it is produced."
+        if TIMINGS_FILE is None:
+            return self._backend.iter_look(command, args)
+        return self._iter_timed(command, args)
+
     def _svn_look(self, command, args=None):
         "Captures a command's standard output."
-        look_option = "--revision" if self._test_mode else "--transaction"
-        look_command = "%s %s %s %s %s" % (SVNLOOK_COMMAND, command, self._repository, look_option, self._transaction)
-        if args:
-            look_command = "%s %s" % (look_command, args)
-        dev_null = open(os.devnull, "w")
-        result = []
+        if TIMINGS_FILE is None:
+            return self._backend.look(command, args)
+        return list(self._iter_timed(command, args))
+
+    def _read_svn_look(self, command, args, size):
+        "Reads at most size bytes of a command's standard output."
+        if TIMINGS_FILE is None:
+            return self._backend.read(command, args, size)
+        started = time.time()
+        output = ""
         try:
-            if self._test_mode:
-                print "[debug]$ %s" % look_command
-            result = subprocess.Popen(look_command.split(), stdout=subprocess.PIPE, stderr=dev_null).communicate()[0].split("\n")
-            if result and result[-1] == "":
-                result.pop()
+            output = self._backend.read(command, args, size)
+            return output
         finally:
-            dev_null.close()
-        return result
+            record_timing({"type": "svnlook", "command": command, "args": args,
+                           "repository": self._repository, "transaction": str(self._transaction),
+                           "backend": self._backend.__class__.__name__,
+                           "seconds": time.time() - started, "lines": output.count("\n"),
+                           "bytes": len(output)})
+
+    def _iter_timed(self, command, args):
+        started = time.time()
+        lines = 0
+        size = 0
+        try:
+            for line in self._backend.iter_look(command, args):
+                lines += 1
+                size += len(line) + 1
+                yield line
+        finally:
+            record_timing({"type": "svnlook", "command": command, "args": args,
+                           "repository": self._repository, "transaction": str(self._transaction),
+                           "backend": self._backend.__class__.__name__,
+                           "seconds": time.time() - started, "lines": lines, "bytes": size})
+
+class ChangeSet(object):
+    """The parsed changes of a transaction. Each change is kept in the slot of its
+    path in a PathTrie, so that the changes below a path are found without going
+    through every change."""
+    def __init__(self, changes):
+        self._changes = []
+        self._paths = PathTrie()
+        self._files_by_status = {}
+        self._copied_files = []
+        for change in changes:
+            status, file, copied = change
+            self._paths.add(file)
+            self._changes.append(change)
+            self._files_by_status.setdefault(status, []).append(file)
+            if copied:
+                self._copied_files.append(file)
+
+    def __iter__(self):
+        return iter(self._changes)
+
+    def __len__(self):
+        return len(self._changes)
+
+    def get_change(self, file):
+        "Returns the (status, file, copied) change of the path, or None if it is unchanged."
+        slot = self._paths.get_slot(file)
+        if slot is None:
+            return None
+        return self._changes[slot]
+
+    def get_changes_under(self, patterns):
+        "Returns the changes of the paths starting with any of the patterns, in order."
+        return [self._changes[slot] for slot, file in self._paths.get_under(patterns)]
+
+    def get_files_with_status(self, *statuses):
+        if len(statuses) == 1:
+            return list(self._files_by_status.get(statuses[0], []))
+        return [file for status, file, copied in self._changes if status in statuses]
+
+    def get_copied_files(self):
+        return list(self._copied_files)
+
+    def has_status(self, file, *statuses):
+        change = self.get_change(file)
+        return change is not None and change[0] in statuses
+
+    def is_copied(self, file):
+        change = self.get_change(file)
+        return change is not None and change[2]
 
 class CommitDetails(SvnLookWrapper):
     STATUS = 0
     FILE = 1
     COPIED = 2
 
+    def __init__(self, repository, transaction, test_mode=False, backend=None, snapshot=None, deadline=None):
+        SvnLookWrapper.__init__(self, repository, transaction, test_mode, backend, snapshot, deadline)
+        self._change_set = None
+        self._commit_message = None
+
     def get_added_files(self):
         return self._get_files_with_status("A")
 
@@ -71,32 +774,73 @@ class CommitDetails(SvnLookWrapper):
         return self._get_files_with_status("A", "D", "U", "_")
 
     def get_copied_files(self):
-        files = []
-        for change in self._get_changes():
-            if change[self.COPIED]:
-                files.append(change[self.FILE])
-        return files
+        return self.get_change_set().get_copied_files()
+
+    def get_changes_under(self, patterns):
+        return self.get_change_set().get_changes_under(patterns)
+
+    def get_file_size(self, file):
+        "Returns the size of a file in bytes, without reading its contents."
+        return int(self._svn_look("filesize", file)[0])
+
+    def read_file_start(self, file, size):
+        "Returns at most the first size bytes of a file."
+        return self._read_svn_look("cat", file, size)
 
     def get_commit_message(self):
-        return "\n".join(self._svn_look("log"))
+        if self._commit_message is None:
+            self._commit_message = "\n".join(self._svn_look("log"))
+        return self._commit_message
+
+    def get_change_set(self):
+        "Returns the transaction's changes, fetched once and then kept in memory."
+        if self._change_set is None:
+            self._change_set = ChangeSet(self._get_changes())
+        return self._change_set
+
+    def iter_changes(self):
+        """Yields the transaction's (status, file, copied) changes. Unless they are
+        already in memory, they are parsed as svnlook produces them and not kept,
+        so callers that stop early never read the rest."""
+        if self._change_set is not None:
+            return iter(self._change_set)
+        return self._iter_changes()
 
     def _get_files_with_status(self, *statuses):
-        files = []
-        for change in self._get_changes():
-            if change[self.STATUS] in statuses:
-                files.append(change[self.FILE])
-        return files
+        return self.get_change_set().get_files_with_status(*statuses)
 
     def _get_changes(self):
-        changes = []
-        for change in self._svn_look("changed --copy-info"):
+        return list(self._iter_changes())
+
+    def _iter_changes(self):
+        for change in self._iter_svn_look("changed --copy-info"):
             status = change[0].strip()
             file = change[4:]
             copied = change[2] == "+"
             if status:
-                changes.append((status, file, copied))
-        return changes
+                yield (status, file, copied)
 
 class RepositoryDetails(SvnLookWrapper):
+    def use_tree_snapshot(self, directory, commit_details):
+        """Answers tree queries from the snapshot of the previous revision in test
+        mode, or of the youngest revision, with the changes of the commit applied.
+        Returns False if there is no such snapshot."""
+        if self._test_mode:
+            revision = int(self._transaction) - 1
+        else:
+            revision = self.get_youngest_revision()
+        tree_snapshot = TreeSnapshot.open(directory, revision)
+        if tree_snapshot is None:
+            return False
+        self._backend = TreeSnapshotBackend(self._backend, tree_snapshot, commit_details.get_change_set)
+        return True
+
     def get_files_in(self, repository_directory):
-        return self._svn_look("tree --full-paths --non-recursive", repository_directory)
+        return list(self.iter_files_in(repository_directory))
+
+    def iter_files_in(self, repository_directory):
+        return self._iter_svn_look("tree --full-paths --non-recursive", repository_directory)
+
+    def iter_tree(self, repository_directory=None):
+        "Yields the full path of every entry in the tree, read from a single svnlook call."
+        return self._iter_svn_look("tree --full-paths", repository_directory)
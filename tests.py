@@ -1,13 +1,35 @@
 #!/usr/bin/python
 import unittest
 import sys
+import os
+import shutil
+import tempfile
+import threading
+import time
+import json
+import socket
+import optparse
+from StringIO import StringIO
 from mockito import mock, when, verify, any, times
-from svn_look_wrappers import CommitDetails, RepositoryDetails
+import svn_look_wrappers
+from svn_look_wrappers import CommitDetails, RepositoryDetails, ChangeSet, SvnLookBackend, \
+    create_backend, format_change, parallel_map, command_output, SvnLookTimeout, \
+    TransactionSnapshot, SnapshotBackend, Deadline, DeadlineExceeded
+import ordered_filename_pre_commit
 from ordered_filename_pre_commit import check_filenames, MIGRATION_PATH, \
-    SKIP_KEYWORD as MIGRATION_SKIP_KEYWORD
+    SKIP_KEYWORD as MIGRATION_SKIP_KEYWORD, MigrationIndex
 from require_commit_message_pre_commit import check_commit_message
-from no_changes_in_tags_pre_commit import fail_on_tag_changes, \
+from no_changes_in_tags_pre_commit import fail_on_tag_changes, is_tagged, \
     SKIP_KEYWORD as TAG_SKIP_KEYWORD
+from no_large_or_binary_files_pre_commit import check_files, is_binary, is_asset, MAX_FILE_SIZE, \
+    BINARY_SNIFF_SIZE, SKIP_KEYWORD as FILE_SKIP_KEYWORD
+from run_pre_commit_checks import run_checks, CHECKS, CHECK_NAMES, FAIL_OPEN
+from path_trie import PathTrie
+from tree_snapshot import TreeSnapshot, TreeSnapshotBackend, write_tree_snapshot
+from path_rules import Rule, RuleSet, TAG, MIGRATION, ASSET, load_rules, RulesError
+from pre_commit_client import request_checks
+from pre_commit_daemon import PreCommitDaemon, RepositoryCache, ThreadLocalStream
+from replay_checks import split_revisions, replay_chunk, write_report
 
 
 class SvnLookWrapperTestCase(unittest.TestCase):
@@ -24,12 +46,19 @@ class SvnLookWrapperTestCase(unittest.TestCase):
         when(self.commit_details).get_deleted_files().thenReturn(self.deleted_files)
         self.modified_files = []
         when(self.commit_details).get_modified_files().thenReturn(self.modified_files)
+        when(self.commit_details).get_changes_under(any()).thenAnswer(
+            lambda patterns: ChangeSet(self.get_changes()).get_changes_under(patterns))
         self.given_commit_message("")
+        when(self.commit_details).get_file_size(any()).thenReturn(0)
+        when(self.commit_details).get_deadline().thenReturn(None)
 
         self.repository_details = mock(RepositoryDetails)
         when(self.repository_details).get_files_in(any()).thenReturn([])
         self.files_in_root = ["/"]
         when(self.repository_details).get_files_in(".").thenReturn(self.files_in_root)
+        self.files_in_tree = ["/"]
+        when(self.repository_details).iter_tree().thenReturn(self.files_in_tree)
+        when(self.repository_details).get_deadline().thenReturn(None)
 
         self.original_stderr = sys.stderr
         self.stderr = mock()
@@ -38,6 +67,15 @@ class SvnLookWrapperTestCase(unittest.TestCase):
     def tearDown(self):
         sys.stderr = self.original_stderr
 
+    def get_changes(self):
+        changes = []
+        for status, files in (("A", self.added_files), ("D", self.deleted_files), ("U", self.modified_files)):
+            changes.extend((status, file, file in self.copied_files) for file in files)
+        changed_files = set(file for status, file, copied in changes)
+        changes.extend(("U", file, file in self.copied_files) for file in self.commit_files
+                       if file not in changed_files)
+        return changes
+
     def given_commit_message(self, message):
         when(self.commit_details).get_commit_message().thenReturn(message)
 
@@ -45,6 +83,7 @@ class SvnLookWrapperTestCase(unittest.TestCase):
         self.files_in_root.append(module)
         file_paths = [module + path + filename for filename in filenames]
         when(self.repository_details).get_files_in(module + path).thenReturn(file_paths)
+        self.files_in_tree.extend([module, module + path] + file_paths)
 
     def given_file_added_in_commit(self, file_path):
         self.added_files.append(file_path)
@@ -96,6 +135,23 @@ class NoChangesInTagsTest(SvnLookWrapperTestCase):
         fail_on_tag_changes(self.commit_details)
         verify(self.stderr).write("Error: Modifying tagged files is not permitted!\n")
 
+    def test_lists_every_modified_tagged_file(self):
+        self.given_file_in_commit("module/tags/tagname/file1.txt")
+        self.given_file_in_commit("module/tags/tagname/file2.txt")
+        self.given_file_in_commit("module/tags/tagname/file3.txt")
+        self.given_file_copied_in_commit("module/tags/tagname/file2.txt")
+        self.then_error_code_is(1)
+        verify(self.stderr).write("  module/tags/tagname/file1.txt\n")
+        verify(self.stderr, times(0)).write("  module/tags/tagname/file2.txt\n")
+        verify(self.stderr).write("  module/tags/tagname/file3.txt\n")
+
+    def test_queries_changes_below_tags_once(self):
+        for i in range(10):
+            self.given_file_in_commit("module/tags/tagname/file%d.txt" % i)
+        fail_on_tag_changes(self.commit_details)
+        verify(self.commit_details, times(1)).get_changes_under(["*/tags/"])
+        verify(self.commit_details, times(0)).get_files()
+
     def test_does_not_fail_when_committing_to_tags_folder_in_trunk(self):
         self.given_file_in_commit("module/trunk/tags/file.txt")
         self.then_error_code_is(0)
@@ -105,6 +161,75 @@ class NoChangesInTagsTest(SvnLookWrapperTestCase):
                          fail_on_tag_changes(self.commit_details))
 
 
+class NoLargeOrBinaryFilesTest(SvnLookWrapperTestCase):
+
+    def test_does_not_fail_for_small_text_file(self):
+        self.given_file_with_contents("module/trunk/file.txt", "text\n")
+        self.number_of_errors_are(0)
+
+    def test_fails_for_file_larger_than_permitted(self):
+        self.given_file_with_contents("module/trunk/file.txt", "text\n", MAX_FILE_SIZE + 1)
+        self.number_of_errors_are(1)
+        verify(self.stderr).write("Error: The file \"module/trunk/file.txt\" is %d bytes, "
+                                  "larger than the permitted %d bytes.\n" % (MAX_FILE_SIZE + 1, MAX_FILE_SIZE))
+
+    def test_does_not_read_files_larger_than_permitted(self):
+        self.given_file_with_contents("module/trunk/file.txt", "text\n", MAX_FILE_SIZE + 1)
+        check_files(self.commit_details)
+        verify(self.commit_details, times(0)).read_file_start(any(), any())
+
+    def test_fails_for_binary_file(self):
+        self.given_file_with_contents("module/trunk/image.png", "\x89PNG\r\n\x1a\n\0\0\0\rIHDR")
+        self.number_of_errors_are(1)
+        verify(self.stderr).write("Error: The file \"module/trunk/image.png\" is binary.\n")
+
+    def test_reads_only_start_of_file(self):
+        self.given_file_with_contents("module/trunk/file.txt", "text\n", MAX_FILE_SIZE)
+        check_files(self.commit_details)
+        verify(self.commit_details).read_file_start("module/trunk/file.txt", BINARY_SNIFF_SIZE)
+
+    def test_checks_modified_files(self):
+        self.given_file_with_contents("module/trunk/image.png", "\0", modified=True)
+        self.number_of_errors_are(1)
+
+    def test_allows_large_and_binary_files_in_assets(self):
+        self.given_file_with_contents("module/trunk/assets/image.png", "\0", MAX_FILE_SIZE + 1)
+        self.number_of_errors_are(0)
+
+    def test_ignores_directories(self):
+        self.given_file_added_in_commit("module/trunk/directory/")
+        self.number_of_errors_are(0)
+
+    def test_allows_commit_when_message_contains_skip_keyword(self):
+        self.given_commit_message(FILE_SKIP_KEYWORD)
+        self.given_file_with_contents("module/trunk/image.png", "\0")
+        self.number_of_errors_are(0)
+
+    def test_counts_errors(self):
+        for i in range(10):
+            self.given_file_with_contents("module/trunk/image%d.png" % i, "\0")
+        self.given_file_with_contents("module/trunk/file.txt", "text\n")
+        self.number_of_errors_are(10)
+
+    def test_tells_text_from_binary(self):
+        self.assertFalse(is_binary(""))
+        self.assertFalse(is_binary("# -*- coding: utf-8 -*-\r\n\tk\xc3\xa4se\f\n"))
+        self.assertTrue(is_binary("text\0"))
+        self.assertTrue(is_binary("\x01\x02\x03" + "a" * 10))
+
+    def given_file_with_contents(self, file_path, contents, size=None, modified=False):
+        if modified:
+            self.given_file_modified_in_commit(file_path)
+        else:
+            self.given_file_added_in_commit(file_path)
+        when(self.commit_details).get_file_size(file_path).thenReturn(len(contents) if size is None else size)
+        when(self.commit_details).read_file_start(file_path, BINARY_SNIFF_SIZE).thenReturn(
+            contents[:BINARY_SNIFF_SIZE])
+
+    def number_of_errors_are(self, number_of_errors):
+        self.assertEqual(number_of_errors, check_files(self.commit_details))
+
+
 class RequireCommitMessageTest(SvnLookWrapperTestCase):
 
     def test_fails_when_commit_message_missing(self):
@@ -171,6 +296,19 @@ since later migrations exist (\"%s\").\n" % ("module/" + MIGRATION_PATH + "0.rb"
         verify(sys.stderr).write("Error: The file \"%s\" may not be modified \
 since later migrations exist (\"%s\").\n" % ("module/" + MIGRATION_PATH + "0.rb", "1.rb"))
 
+    def test_reports_every_violation_with_next_allowed_filenames(self):
+        self.given_existing_files("module1/", MIGRATION_PATH, "005_a.rb")
+        self.given_file_added_in_commit("module1/" + MIGRATION_PATH + "003_b.rb")
+        self.given_file_added_in_commit("module2/" + MIGRATION_PATH + "004_c.rb")
+        self.given_file_added_in_commit("module2/" + MIGRATION_PATH + "006_d.rb")
+        self.number_of_errors_are(2)
+        verify(sys.stderr).write("It could be added as \"%s\" instead.\n" % ("module1/" + MIGRATION_PATH + "007_b.rb"))
+        verify(sys.stderr).write("It could be added as \"%s\" instead.\n" % ("module2/" + MIGRATION_PATH + "008_c.rb"))
+
+    def test_next_filename_keeps_the_width_of_the_number(self):
+        self.assertEqual("010_b.rb", ordered_filename_pre_commit.get_next_filename("009_a.rb", "001_b.rb"))
+        self.assertEqual("2_b.sql", ordered_filename_pre_commit.get_next_filename("1.rb", "b.sql"))
+        self.assertEqual(None, ordered_filename_pre_commit.get_next_filename("9.rb", "1.rb"))
 
     def test_does_not_print_to_stderr_when_successful(self):
         self.given_file_added_in_commit("module/" + MIGRATION_PATH + "0.rb")
@@ -221,5 +359,1100 @@ include \"%s\" in the commit message.\n" % MIGRATION_SKIP_KEYWORD)
                           check_filenames(self.commit_details, self.repository_details))
 
 
+class OrderedFilenameByModuleTest(OrderedFilenameTest):
+
+    def setUp(self):
+        OrderedFilenameTest.setUp(self)
+        self.original_discovery = ordered_filename_pre_commit.MIGRATION_DISCOVERY
+        ordered_filename_pre_commit.MIGRATION_DISCOVERY = "modules"
+
+    def tearDown(self):
+        ordered_filename_pre_commit.MIGRATION_DISCOVERY = self.original_discovery
+        OrderedFilenameTest.tearDown(self)
+
+
+class MigrationDiscoveryTest(SvnLookWrapperTestCase):
+
+    def setUp(self):
+        SvnLookWrapperTestCase.setUp(self)
+        self.original_discovery = ordered_filename_pre_commit.MIGRATION_DISCOVERY
+        self.given_existing_files("module1/", MIGRATION_PATH, "1.rb")
+        self.given_existing_files("module2/", MIGRATION_PATH, "2.rb")
+        self.given_file_added_in_commit("module1/" + MIGRATION_PATH + "3.rb")
+
+    def tearDown(self):
+        ordered_filename_pre_commit.MIGRATION_DISCOVERY = self.original_discovery
+        SvnLookWrapperTestCase.tearDown(self)
+
+    def test_reads_whole_tree_in_one_call(self):
+        ordered_filename_pre_commit.MIGRATION_DISCOVERY = "tree"
+        check_filenames(self.commit_details, self.repository_details)
+        verify(self.repository_details, times(1)).iter_tree()
+        verify(self.repository_details, times(0)).get_files_in(any())
+
+    def test_lists_migration_path_in_each_module(self):
+        ordered_filename_pre_commit.MIGRATION_DISCOVERY = "modules"
+        check_filenames(self.commit_details, self.repository_details)
+        verify(self.repository_details).get_files_in("module1/" + MIGRATION_PATH)
+        verify(self.repository_details).get_files_in("module2/" + MIGRATION_PATH)
+        verify(self.repository_details, times(0)).iter_tree()
+
+
+class MigrationIndexTest(SvnLookWrapperTestCase):
+
+    def setUp(self):
+        SvnLookWrapperTestCase.setUp(self)
+        self.index = MigrationIndex("repository", 1)
+        self.index.add("module1/" + MIGRATION_PATH + "1.rb")
+        self.index.add("module2/" + MIGRATION_PATH + "3.rb")
+        self.index.add("module2/" + MIGRATION_PATH + "2.rb")
+
+    def test_returns_last_filename_of_all_directories(self):
+        self.assertEqual("3.rb", self.index.get_last_filenames()[MIGRATION])
+
+    def test_ignores_excluded_files(self):
+        self.assertEqual("2.rb", self.index.get_last_filenames(
+            ["module2/" + MIGRATION_PATH + "3.rb"])[MIGRATION])
+
+    def test_ignores_files_in_excluded_directories(self):
+        self.assertEqual("1.rb", self.index.get_last_filenames(["module2/"])[MIGRATION])
+
+    def test_applies_added_and_deleted_files(self):
+        self.assertTrue(self.index.apply_changes(2, [
+            ("A", "module1/" + MIGRATION_PATH + "4.rb", False),
+            ("D", "module2/" + MIGRATION_PATH + "3.rb", False),
+            ("A", "module1/trunk/other/5.rb", False)]))
+        self.assertEqual(2, self.index.revision)
+        self.assertEqual("4.rb", self.index.get_last_filenames()[MIGRATION])
+        self.assertEqual("2.rb", self.index.get_last_filenames(
+            ["module1/" + MIGRATION_PATH + "4.rb"])[MIGRATION])
+
+    def test_applies_deleted_directories(self):
+        self.assertTrue(self.index.apply_changes(2, [("D", "module2/", False)]))
+        self.assertEqual("1.rb", self.index.get_last_filenames()[MIGRATION])
+
+    def test_requires_rebuild_when_directory_with_files_is_copied(self):
+        self.assertFalse(self.index.apply_changes(2, [("A", "module3/trunk/", True)]))
+
+    def test_does_not_require_rebuild_when_other_directory_is_copied(self):
+        self.assertTrue(self.index.apply_changes(2, [("A", "module3/tags/1.0/", True)]))
+
+    def test_can_be_saved_and_loaded(self):
+        index_dir = tempfile.mkdtemp()
+        try:
+            index_path = os.path.join(index_dir, "index.json")
+            self.index.save(index_path)
+            loaded_index = MigrationIndex.load(index_path)
+        finally:
+            shutil.rmtree(index_dir)
+        self.assertEqual(("repository", 1, "3.rb"), (loaded_index.repository,
+            loaded_index.revision, loaded_index.get_last_filenames()[MIGRATION]))
+
+    def test_is_not_loaded_when_missing(self):
+        self.assertEqual(None, MigrationIndex.load("/nonexistent/index.json"))
+
+    def test_is_used_by_check_instead_of_repository_tree(self):
+        self.given_file_added_in_commit("module1/" + MIGRATION_PATH + "0.rb")
+        self.assertEqual(1, check_filenames(self.commit_details, self.repository_details, self.index))
+        verify(self.repository_details, times(0)).iter_tree()
+
+    def test_is_not_used_when_directory_with_files_is_copied_in_commit(self):
+        self.given_existing_files("module3/", MIGRATION_PATH, "4.rb")
+        self.given_file_added_in_commit("module1/" + MIGRATION_PATH + "0.rb")
+        self.given_file_copied_in_commit("module3/")
+        check_filenames(self.commit_details, self.repository_details, self.index)
+        verify(self.repository_details).iter_tree()
+
+    def test_orders_files_of_rules_sharing_a_directory_like_the_tree(self):
+        rules = RuleSet([Rule(MIGRATION, "migrations", "*/" + MIGRATION_PATH, "[0-9]+.*\\.rb$"),
+                         Rule(MIGRATION, "scripts", "*/" + MIGRATION_PATH, "[0-9]+.*\\.sql$")])
+        self.given_existing_files("module1/", MIGRATION_PATH, "3.sql", "5.rb")
+        self.given_file_added_in_commit("module1/" + MIGRATION_PATH + "1.sql")
+        index = MigrationIndex("repository", 1, rules=rules)
+        index.add("module1/" + MIGRATION_PATH + "3.sql")
+        index.add("module1/" + MIGRATION_PATH + "5.rb")
+        self.assertEqual(1, check_filenames(self.commit_details, self.repository_details, rules=rules))
+        self.assertEqual(1, check_filenames(self.commit_details, self.repository_details, index, rules))
+
+
+class RunChecksTest(SvnLookWrapperTestCase):
+
+    def test_does_not_fail_when_all_checks_pass(self):
+        self.given_commit_message("...")
+        self.given_file_in_commit("module/trunk/file.txt")
+        self.then_failed_checks_are(0)
+
+    def test_counts_each_failed_check(self):
+        self.given_commit_message("..")
+        self.given_file_in_commit("module/tags/tagname/file.txt")
+        self.then_failed_checks_are(2)
+
+    def test_counts_failed_check_once_regardless_of_errors(self):
+        self.given_commit_message("...")
+        self.given_existing_files("module/", MIGRATION_PATH, "10.rb")
+        self.given_file_added_in_commit("module/" + MIGRATION_PATH + "0.rb")
+        self.given_file_added_in_commit("module/" + MIGRATION_PATH + "1.rb")
+        self.then_failed_checks_are(1)
+
+    def test_runs_only_enabled_checks(self):
+        self.given_commit_message("..")
+        self.given_file_in_commit("module/tags/tagname/file.txt")
+        self.then_failed_checks_are(1, ["no-tag-changes"])
+
+    def test_stops_after_first_failed_check_when_failing_fast(self):
+        self.given_commit_message("..")
+        self.given_file_in_commit("module/tags/tagname/file.txt")
+        self.given_file_added_in_commit("module/" + MIGRATION_PATH + "0.rb")
+        self.assertEqual(1, run_checks(self.commit_details, self.repository_details, fail_fast=True))
+        verify(self.commit_details, times(0)).get_files()
+        verify(self.repository_details, times(0)).iter_tree()
+
+    def test_does_not_fetch_changes_when_all_checks_needing_them_are_skipped(self):
+        self.given_commit_message("%s %s %s" % (TAG_SKIP_KEYWORD, MIGRATION_SKIP_KEYWORD, FILE_SKIP_KEYWORD))
+        self.then_failed_checks_are(0)
+        verify(self.commit_details, times(0)).get_files()
+        verify(self.commit_details, times(0)).get_added_files()
+
+    def test_runs_cheapest_check_first(self):
+        self.assertEqual(["commit-message", "no-tag-changes", "ordered-filenames", "no-large-or-binary-files"],
+                         [check.name for check in sorted(reversed(CHECKS), key=lambda check: check.get_cost())])
+
+    def test_fails_check_closed_when_deadline_has_passed(self):
+        self.given_deadline(-1)
+        self.given_file_in_commit("module/trunk/file.txt")
+        self.then_failed_checks_are(1, ["no-tag-changes"])
+        verify(self.stderr).write("Error: The check \"no-tag-changes\" could not finish before the deadline.\n")
+        verify(self.stderr).write("Degraded checks: no-tag-changes (fail-closed)\n")
+
+    def test_fails_check_open_when_policy_says_so(self):
+        self.given_deadline(-1)
+        self.assertEqual(0, run_checks(self.commit_details, self.repository_details, ["no-tag-changes"],
+                                       degrade_policies={"no-tag-changes": FAIL_OPEN}))
+        verify(self.stderr).write("Degraded checks: no-tag-changes (fail-open)\n")
+
+    def test_answers_from_cached_migration_index_when_too_little_time_is_left(self):
+        self.given_deadline(1)
+        self.given_file_added_in_commit("module/" + MIGRATION_PATH + "0.rb")
+        cached_index = MigrationIndex("repository", 1)
+        cached_index.add("module/" + MIGRATION_PATH + "1.rb")
+        self.assertEqual(1, run_checks(self.commit_details, self.repository_details, ["ordered-filenames"],
+                                       migration_index_loader=lambda repository_details, rules: None,
+                                       cached_migration_index_loader=lambda repository_details, rules: cached_index))
+        verify(self.repository_details, times(0)).iter_tree()
+        verify(self.stderr).write("Degraded checks: ordered-filenames (cached)\n")
+
+    def test_fails_closed_without_cached_migration_index(self):
+        self.given_deadline(1)
+        self.given_file_added_in_commit("module/" + MIGRATION_PATH + "0.rb")
+        self.then_failed_checks_are(1, ["ordered-filenames"])
+        verify(self.stderr).write("Degraded checks: ordered-filenames (fail-closed)\n")
+
+    def test_does_not_report_degraded_checks_within_deadline(self):
+        self.given_deadline(60)
+        self.given_commit_message("...")
+        self.then_failed_checks_are(0)
+        verify(self.stderr, times(0)).write(any())
+
+    def given_deadline(self, seconds):
+        deadline = Deadline(seconds)
+        when(self.commit_details).get_deadline().thenReturn(deadline)
+        when(self.repository_details).get_deadline().thenReturn(deadline)
+
+    def then_failed_checks_are(self, failed_checks, enabled_checks=None):
+        self.assertEqual(failed_checks,
+                         run_checks(self.commit_details, self.repository_details, enabled_checks))
+
+
+class PreCommitDaemonTest(SvnLookWrapperTestCase):
+
+    def setUp(self):
+        SvnLookWrapperTestCase.setUp(self)
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_dir, "socket")
+        sys.stderr = ThreadLocalStream(self.stderr)
+        self.daemon = PreCommitDaemon(self.socket_path, RepositoryCache(), sys.stderr)
+        self.daemon.create_wrappers = lambda repository, transaction, test_mode: \
+            (self.commit_details, self.repository_details)
+        self.daemon.cache.get_migration_index = lambda repository_details, rules: None
+        self.daemon_thread = threading.Thread(target=self.daemon.serve_forever)
+        self.daemon_thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.daemon.server_close()
+        self.daemon_thread.join()
+        shutil.rmtree(self.socket_dir)
+        SvnLookWrapperTestCase.tearDown(self)
+
+    def request(self, checks=None):
+        return request_checks(self.socket_path, {"repository": "/nonexistent/repository",
+                                                 "transaction": "1-1", "checks": checks})
+
+    def test_relays_exit_code_and_errors(self):
+        self.given_commit_message("..")
+        self.given_file_in_commit("module/tags/tagname/file.txt")
+        self.assertEqual((2, "Error: Please enter a descriptive commit message!\n"
+                          "Error: Modifying tagged files is not permitted!\n"
+                          "  module/tags/tagname/file.txt\n"), self.request())
+
+    def test_runs_requested_checks(self):
+        self.given_commit_message("..")
+        self.given_file_in_commit("module/tags/tagname/file.txt")
+        self.assertEqual(1, self.request(["no-tag-changes"])[0])
+
+    def test_handles_concurrent_requests(self):
+        self.given_commit_message("...")
+        results = []
+        def request():
+            results.append(self.request(["commit-message"]))
+        threads = [threading.Thread(target=request) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([(0, "")] * 8, results)
+
+    def test_rejects_unknown_checks(self):
+        self.given_commit_message("..")
+        self.assertEqual((1, "Error: Unknown checks: commit-mesage. Available checks are %s.\n"
+                          % ", ".join(CHECK_NAMES)), self.request(["commit-mesage"]))
+
+    def test_answers_invalid_requests_with_an_error(self):
+        for line in ["not json", "[1]", json.dumps({"repository": "/nonexistent/repository"})]:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.connect(self.socket_path)
+                connection.sendall(line + "\n")
+                response = json.loads(connection.makefile("r").readline())
+            finally:
+                connection.close()
+            self.assertEqual(1, response["exit_code"])
+            self.assertTrue(response["stderr"].startswith("Error: invalid request to the pre-commit daemon: "))
+
+    def test_client_does_not_trust_socket_in_shared_directory(self):
+        os.chmod(self.socket_dir, 0777)
+        self.assertRaises(socket.error, self.request)
+
+    def test_client_rejects_empty_response(self):
+        def fail(request):
+            raise RuntimeError("The request handler failed")
+        self.daemon.run_request = fail
+        self.daemon.handle_error = lambda request, client_address: None
+        self.assertRaises(ValueError, self.request)
+
+
+class ReplayChecksTest(unittest.TestCase):
+
+    def test_splits_revisions_into_contiguous_chunks(self):
+        self.assertEqual([(1, 4), (5, 8), (9, 10)], split_revisions(1, 10, 4))
+        self.assertEqual([(7, 7)], split_revisions(7, 7, 4))
+
+    def test_builds_no_migration_index_without_ordered_filename_check(self):
+        temp_dir = tempfile.mkdtemp()
+        original_settings = (svn_look_wrappers.SVNLOOK_COMMAND, svn_look_wrappers.SVNLOOK_BACKEND, sys.stdout)
+        try:
+            svn_look_wrappers.SVNLOOK_COMMAND = os.path.join(temp_dir, "svnlook")
+            svn_look_wrappers.SVNLOOK_BACKEND = "svnlook"
+            stub = open(svn_look_wrappers.SVNLOOK_COMMAND, "w")
+            stub.write("#!/bin/sh\necho \"$1\" >> %s/queries\necho \"A descriptive message\"\n" % temp_dir)
+            stub.close()
+            os.chmod(svn_look_wrappers.SVNLOOK_COMMAND, 0700)
+            sys.stdout = StringIO()
+            verdicts = replay_chunk(("repository", (3, 4), ["commit-message"]))
+            queries = open(os.path.join(temp_dir, "queries")).read()
+            printed = sys.stdout.getvalue()
+        finally:
+            svn_look_wrappers.SVNLOOK_COMMAND, svn_look_wrappers.SVNLOOK_BACKEND, sys.stdout = original_settings
+            shutil.rmtree(temp_dir)
+        self.assertEqual([0, 0], [verdict["result"] for verdict in verdicts])
+        self.assertEqual("log\nlog\n", queries)
+        self.assertEqual("", printed)
+
+    def test_writes_csv_report(self):
+        output = StringIO()
+        write_report([{"revision": 5, "check": "commit-message", "result": 1,
+                       "errors": "Error: Please enter a descriptive commit message!\n"}], output, "csv")
+        self.assertEqual('revision,check,result,errors\r\n5,commit-message,1,"Error: Please ' \
+                         'enter a descriptive commit message!\n"\r\n', output.getvalue())
+
+    def test_writes_json_report(self):
+        output = StringIO()
+        write_report([{"revision": 5, "check": "commit-message", "result": 0, "errors": ""}], output, "json")
+        self.assertEqual({"revision": 5, "check": "commit-message", "result": 0, "errors": ""},
+                         json.loads(output.getvalue()))
+
+
+class CommitDetailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.commit_details = CommitDetails("repository", "1-1")
+        when(self.commit_details)._iter_svn_look("changed --copy-info").thenReturn([
+            "A   module/trunk/added.txt",
+            "U   module/trunk/modified.txt",
+            "D   module/trunk/deleted.txt",
+            "A + module/tags/tagname/",
+            "    (from module/trunk/:r1)"])
+        when(self.commit_details)._svn_look("log").thenReturn(["message"])
+
+    def test_classifies_files_by_status(self):
+        self.assertEqual(["module/trunk/added.txt", "module/tags/tagname/"],
+                         self.commit_details.get_added_files())
+        self.assertEqual(["module/trunk/modified.txt"],
+                         self.commit_details.get_modified_files())
+        self.assertEqual(["module/trunk/deleted.txt"],
+                         self.commit_details.get_deleted_files())
+        self.assertEqual(["module/tags/tagname/"],
+                         self.commit_details.get_copied_files())
+        self.assertEqual(4, len(self.commit_details.get_files()))
+
+    def test_indexes_changes_by_path(self):
+        change_set = self.commit_details.get_change_set()
+        self.assertEqual(("D", "module/trunk/deleted.txt", False),
+                         change_set.get_change("module/trunk/deleted.txt"))
+        self.assertEqual(None, change_set.get_change("module/trunk/unchanged.txt"))
+        self.assertTrue(change_set.has_status("module/trunk/added.txt", "A", "U"))
+        self.assertFalse(change_set.has_status("module/trunk/added.txt", "D"))
+        self.assertTrue(change_set.is_copied("module/tags/tagname/"))
+        self.assertFalse(change_set.is_copied("module/trunk/added.txt"))
+
+    def test_finds_changes_under_path(self):
+        self.assertEqual([("A", "module/tags/tagname/", True)],
+                         self.commit_details.get_changes_under(["*/tags/"]))
+        self.assertEqual(["module/trunk/added.txt", "module/trunk/modified.txt", "module/trunk/deleted.txt"],
+                         [file for status, file, copied in self.commit_details.get_changes_under(["module/trunk/"])])
+
+    def test_runs_svnlook_once_per_transaction(self):
+        self.commit_details.get_added_files()
+        self.commit_details.get_deleted_files()
+        self.commit_details.get_copied_files()
+        self.commit_details.get_commit_message()
+        self.commit_details.get_commit_message()
+        verify(self.commit_details, times(1))._iter_svn_look("changed --copy-info")
+        verify(self.commit_details, times(1))._svn_look("log")
+
+    def test_parses_changes_formatted_by_bindings_backend(self):
+        commit_details = CommitDetails("repository", "1-1")
+        lines = format_change("A ", "module/trunk/added.txt", False)
+        lines += format_change("_U", "module/trunk/properties.txt", False)
+        lines += format_change("A ", "module/tags/tagname/", True, ("module/trunk/", 1))
+        when(commit_details)._iter_svn_look("changed --copy-info").thenReturn(lines)
+        self.assertEqual(["A   module/trunk/added.txt",
+                          "_U  module/trunk/properties.txt",
+                          "A + module/tags/tagname/",
+                          "    (from module/trunk/:r1)"], lines)
+        self.assertEqual(["module/tags/tagname/"], commit_details.get_copied_files())
+        self.assertEqual(3, len(commit_details.get_files()))
+
+    def test_uses_svnlook_backend_when_bindings_are_not_available(self):
+        if svn_look_wrappers.svn_core is not None:
+            self.skipTest("the Subversion Python bindings are installed")
+        self.assertTrue(isinstance(create_backend("repository", "1-1", backend="auto"), SvnLookBackend))
+        self.assertRaises(ImportError, create_backend, "repository", "1-1", backend="bindings")
+
+    def test_streams_changes_without_keeping_them(self):
+        changes = self.commit_details.iter_changes()
+        self.assertEqual(("A", "module/trunk/added.txt", False), next(changes))
+        self.assertEqual(None, self.commit_details._change_set)
+
+    def test_streams_cached_changes_without_svnlook(self):
+        self.commit_details.get_files()
+        self.assertEqual(4, len(list(self.commit_details.iter_changes())))
+        verify(self.commit_details, times(1))._iter_svn_look("changed --copy-info")
+
+    def test_returned_lists_do_not_alter_cached_changes(self):
+        self.commit_details.get_deleted_files().append("module/trunk/other.txt")
+        self.assertEqual(["module/trunk/deleted.txt"],
+                         self.commit_details.get_deleted_files())
+
+
+class FakeSvnBindings(object):
+    """Stands in for the svn.core, svn.fs and svn.repos modules of the Subversion
+    Python bindings, serving revision 1 and a transaction based on it. Trees map
+    paths to file contents, or to None for directories, which end with "/"."""
+    SVN_PROP_REVISION_LOG = "svn:log"
+    svn_node_none, svn_node_file, svn_node_dir = range(3)
+    path_change_modify, path_change_add, path_change_delete, path_change_replace = range(4)
+
+    class Change(object):
+        def __init__(self, change_kind, node_kind, text_mod=False, prop_mod=False):
+            self.change_kind = change_kind
+            self.node_kind = node_kind
+            self.text_mod = text_mod
+            self.prop_mod = prop_mod
+
+    class Entry(object):
+        def __init__(self, kind):
+            self.kind = kind
+
+    def __init__(self, base_tree, tree, changes, copies, log):
+        self.trees = {"base": base_tree, "transaction": tree}
+        self.changes = changes
+        self.copies = copies
+        self.log = log
+
+    def svn_path_canonicalize(self, path):
+        return path
+
+    def svn_stream_read(self, stream, size):
+        return stream.read(size)
+
+    def svn_stream_close(self, stream):
+        stream.close()
+
+    def open(self, path):
+        return path
+
+    def fs(self, repository):
+        return repository
+
+    def youngest_rev(self, fs):
+        return 1
+
+    def revision_root(self, fs, revision):
+        return "transaction" if revision == 2 else "base"
+
+    def revision_prop(self, fs, revision, name):
+        return self.log
+
+    def open_txn(self, fs, name):
+        return name
+
+    def txn_root(self, txn):
+        return "transaction"
+
+    def txn_base_revision(self, txn):
+        return 1
+
+    def txn_prop(self, txn, name):
+        return self.log
+
+    def check_path(self, root, path):
+        path = path.lstrip("/")
+        if not path or path + "/" in self.trees[root]:
+            return self.svn_node_dir
+        if path in self.trees[root]:
+            return self.svn_node_file
+        return self.svn_node_none
+
+    def dir_entries(self, root, path):
+        prefix = path.strip("/") + "/" if path.strip("/") else ""
+        entries = {}
+        for entry_path in self.trees[root]:
+            name = entry_path[len(prefix):]
+            if entry_path.startswith(prefix) and name and "/" not in name.rstrip("/"):
+                entries[name.rstrip("/")] = self.Entry(self.svn_node_dir if name.endswith("/") else self.svn_node_file)
+        return entries
+
+    def file_length(self, root, path):
+        return len(self.trees[root][path.lstrip("/")])
+
+    def file_contents(self, root, path):
+        return StringIO(self.trees[root][path.lstrip("/")])
+
+    def paths_changed2(self, root):
+        return self.changes
+
+    def copied_from(self, root, path):
+        return self.copies.get(path, (-1, None))
+
+
+class BindingsBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original_modules = (svn_look_wrappers.svn_core, svn_look_wrappers.svn_fs, svn_look_wrappers.svn_repos)
+        base_tree = {"module/": None, "module/trunk/": None, "module/trunk/file.txt": "old",
+                     "module/trunk/removed/": None, "module/trunk/removed.txt": "removed"}
+        tree = {"module/": None, "module/trunk/": None, "module/trunk/file.txt": "new contents",
+                "module/trunk/a file.txt": "added", "module/tags/": None, "module/tags/1.0/": None,
+                "module/tags/1.0/file.txt": "old"}
+        Change = FakeSvnBindings.Change
+        bindings = FakeSvnBindings(base_tree, tree, {
+            "/module/trunk/file.txt": Change(FakeSvnBindings.path_change_modify, FakeSvnBindings.svn_node_file, True),
+            "/module/trunk/a file.txt": Change(FakeSvnBindings.path_change_add, FakeSvnBindings.svn_node_file,
+                                               prop_mod=True),
+            "/module/tags/1.0": Change(FakeSvnBindings.path_change_add, FakeSvnBindings.svn_node_dir),
+            "/module/trunk/removed": Change(FakeSvnBindings.path_change_delete, FakeSvnBindings.svn_node_none),
+            "/module/trunk/removed.txt": Change(FakeSvnBindings.path_change_delete, FakeSvnBindings.svn_node_none)},
+            {"/module/tags/1.0": (1, "/module/trunk")}, "Tag 1.0\nand change files")
+        svn_look_wrappers.svn_core = svn_look_wrappers.svn_fs = svn_look_wrappers.svn_repos = bindings
+        self.commit_details = CommitDetails("repository", "1-1", backend="bindings")
+        self.repository_details = RepositoryDetails("repository", "1-1", backend="bindings")
+
+    def tearDown(self):
+        svn_look_wrappers.svn_core, svn_look_wrappers.svn_fs, svn_look_wrappers.svn_repos = self.original_modules
+
+    def test_formats_changes_like_svnlook(self):
+        self.assertEqual(["A + module/tags/1.0/",
+                          "    (from module/trunk:r1)",
+                          "AU  module/trunk/a file.txt",
+                          "U   module/trunk/file.txt",
+                          "D   module/trunk/removed/",
+                          "D   module/trunk/removed.txt"], self.commit_details._backend.look("changed --copy-info"))
+
+    def test_answers_commit_details(self):
+        self.assertEqual("Tag 1.0\nand change files", self.commit_details.get_commit_message())
+        self.assertEqual(["module/tags/1.0/"], self.commit_details.get_copied_files())
+        self.assertEqual(["module/tags/1.0/", "module/trunk/a file.txt"], self.commit_details.get_added_files())
+        self.assertEqual(["module/trunk/file.txt"], self.commit_details.get_modified_files())
+        self.assertEqual(["module/trunk/removed/", "module/trunk/removed.txt"], self.commit_details.get_deleted_files())
+
+    def test_reads_file_size_and_contents(self):
+        self.assertEqual(12, self.commit_details.get_file_size("module/trunk/file.txt"))
+        self.assertEqual("new", self.commit_details.read_file_start("module/trunk/file.txt", 3))
+        self.assertEqual("added", self.commit_details.read_file_start("module/trunk/a file.txt", 1024))
+
+    def test_lists_tree_like_svnlook(self):
+        self.assertEqual(["/", "module/", "module/tags/", "module/tags/1.0/", "module/tags/1.0/file.txt",
+                          "module/trunk/", "module/trunk/a file.txt", "module/trunk/file.txt"],
+                         list(self.repository_details.iter_tree()))
+        self.assertEqual(["module/trunk/", "module/trunk/a file.txt", "module/trunk/file.txt"],
+                         self.repository_details.get_files_in("module/trunk/"))
+        self.assertEqual(["/", "module/"], self.repository_details.get_files_in("."))
+        self.assertEqual(["module/trunk/file.txt"], self.repository_details.get_files_in("module/trunk/file.txt"))
+        self.assertEqual([], self.repository_details.get_files_in("module/missing/"))
+
+    def test_calls_bindings_one_at_a_time(self):
+        bindings = svn_look_wrappers.svn_fs
+        file_length = bindings.file_length
+        active = []
+        most_active = []
+        def counting_file_length(root, path):
+            active.append(path)
+            most_active.append(len(active))
+            time.sleep(0.01)
+            active.remove(path)
+            return file_length(root, path)
+        bindings.file_length = counting_file_length
+        sizes = parallel_map(self.commit_details.get_file_size, ["module/trunk/file.txt"] * 8, jobs=4)
+        self.assertEqual([12] * 8, sizes)
+        self.assertEqual(1, max(most_active))
+
+    def test_stops_tree_walk_at_deadline(self):
+        deadline = Deadline(60)
+        repository_details = RepositoryDetails("repository", "1-1", backend="bindings", deadline=deadline)
+        tree = repository_details.iter_tree()
+        self.assertEqual(["/", "module/"], [next(tree), next(tree)])
+        deadline._end = time.time() - 1
+        self.assertRaises(DeadlineExceeded, list, tree)
+
+    def test_stops_tree_walk_after_timeout(self):
+        original_timeout = svn_look_wrappers.SVNLOOK_TIMEOUT
+        svn_look_wrappers.SVNLOOK_TIMEOUT = 0.01
+        try:
+            tree = self.repository_details.iter_tree()
+            next(tree)
+            time.sleep(0.02)
+            self.assertRaises(SvnLookTimeout, list, tree)
+        finally:
+            svn_look_wrappers.SVNLOOK_TIMEOUT = original_timeout
+
+    def test_runs_checks_on_commit(self):
+        original_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertEqual(0, run_checks(self.commit_details, self.repository_details,
+                                           ["commit-message", "no-tag-changes", "ordered-filenames"]))
+        finally:
+            sys.stderr = original_stderr
+
+
+class PathTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = PathTrie(["/", "module1/", "module1/tags/", "module1/tags/1.0/", "module1/tags/1.0/file.txt",
+                              "module1/trunk/", "module1/trunk/tags/file.txt", "module2/tags/2.0/"])
+
+    def test_gives_each_path_a_slot(self):
+        self.assertEqual(8, len(self.trie))
+        self.assertEqual(4, self.trie.get_slot("module1/tags/1.0/file.txt"))
+        self.assertEqual(3, self.trie.get_slot("module1/tags/1.0/"))
+        self.assertEqual(None, self.trie.get_slot("module1/tags/1.0"))
+        self.assertEqual(None, self.trie.get_slot("module3/"))
+
+    def test_returns_paths_under_pattern_in_slot_order(self):
+        self.assertEqual([(2, "module1/tags/"), (3, "module1/tags/1.0/"), (4, "module1/tags/1.0/file.txt"),
+                          (7, "module2/tags/2.0/")], self.trie.get_under(["*/tags/"]))
+        self.assertEqual([(4, "module1/tags/1.0/file.txt")], self.trie.get_under(["module1/tags/1.0/f"]))
+
+    def test_returns_paths_under_any_pattern_once(self):
+        self.assertEqual([3, 4, 6], [slot for slot, path in
+                                     self.trie.get_under(["*/*/1.0/", "module1/t*/*/file", "*/tags/1.0/"])])
+
+    def test_keeps_file_and_directory_of_same_name_apart(self):
+        trie = PathTrie(["module/trunk/" + "a" * 10, "module/trunk/" + "a" * 10 + "/"])
+        self.assertEqual(1, trie.get_slot("module/trunk/" + "a" * 10 + "/"))
+        self.assertEqual(0, trie.get_slot("module/trunk/" + "a" * 10))
+
+
+class CountingBackend(object):
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.queries = []
+
+    def iter_look(self, command, args=None):
+        self.queries.append(command)
+        return iter(self.outputs[command])
+
+
+class TransactionSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.repository = os.path.join(self.temp_dir, "repository")
+        os.makedirs(os.path.join(self.repository, "db", "transactions", "1-1.txn"))
+        self.directory = os.path.join(self.temp_dir, "snapshots")
+        self.backend = CountingBackend({"log": ["message"],
+                                        "changed --copy-info": ["A   module/trunk/file.txt"]})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_is_only_used_when_enabled(self):
+        original_directory = svn_look_wrappers.SNAPSHOT_DIRECTORY
+        try:
+            parser = svn_look_wrappers.get_option_parser("")
+            for arguments, directory in [([], None),
+                                         (["--snapshot"], svn_look_wrappers.DEFAULT_SNAPSHOT_DIRECTORY),
+                                         (["--snapshot-dir", self.directory], self.directory)]:
+                svn_look_wrappers.SNAPSHOT_DIRECTORY = None
+                svn_look_wrappers.configure(parser.parse_args(arguments)[0])
+                self.assertEqual(directory, svn_look_wrappers.SNAPSHOT_DIRECTORY)
+        finally:
+            svn_look_wrappers.SNAPSHOT_DIRECTORY = original_directory
+
+    def create_commit_details(self, backend):
+        commit_details = CommitDetails(self.repository, "1-1")
+        snapshot = TransactionSnapshot.open(self.repository, "1-1", self.directory)
+        commit_details._backend = SnapshotBackend(backend, snapshot)
+        return commit_details, snapshot
+
+    def test_later_scripts_load_results_instead_of_querying(self):
+        commit_details, snapshot = self.create_commit_details(self.backend)
+        commit_details.get_commit_message()
+        commit_details.get_added_files()
+        snapshot.save()
+        later_backend = CountingBackend({})
+        commit_details, snapshot = self.create_commit_details(later_backend)
+        self.assertEqual("message", commit_details.get_commit_message())
+        self.assertEqual(["module/trunk/file.txt"], commit_details.get_added_files())
+        self.assertEqual([], later_backend.queries)
+
+    def test_does_not_keep_partially_read_results(self):
+        commit_details, snapshot = self.create_commit_details(self.backend)
+        next(commit_details.iter_changes())
+        snapshot.save()
+        self.assertFalse(os.listdir(self.directory))
+
+    def test_keeps_results_saved_by_other_scripts(self):
+        commit_details, snapshot = self.create_commit_details(self.backend)
+        other_commit_details, other_snapshot = self.create_commit_details(self.backend)
+        commit_details.get_commit_message()
+        other_commit_details.get_added_files()
+        snapshot.save()
+        other_snapshot.save()
+        self.assertEqual(["message"], self.create_commit_details(self.backend)[1].get("log", None))
+
+    def test_removes_snapshots_of_finished_transactions(self):
+        commit_details, snapshot = self.create_commit_details(self.backend)
+        commit_details.get_commit_message()
+        snapshot.save()
+        os.rmdir(os.path.join(self.repository, "db", "transactions", "1-1.txn"))
+        TransactionSnapshot.open(self.repository, "2-2", self.directory)
+        self.assertFalse(os.listdir(self.directory))
+
+    def test_is_not_used_in_directory_accessible_by_others(self):
+        os.mkdir(self.directory)
+        os.chmod(self.directory, 0777)
+        self.assertEqual(None, TransactionSnapshot.open(self.repository, "1-1", self.directory))
+
+
+class TreeSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.paths = ["module1/", "module1/tags/", "module1/tags/1.0/", "module1/tags/1.0/file.txt",
+                      "module1/trunk/", "module1/trunk/db/", "module1/trunk/db/migrations/",
+                      "module1/trunk/db/migrations/1.rb", "module1/trunk/db/migrations/2.rb",
+                      "module1/trunk/file.txt", "module1-old/", "module2/", "module2/trunk/"]
+        write_tree_snapshot(["/"] + sorted(self.paths), self.temp_dir, 5)
+        self.snapshot = TreeSnapshot.open(self.temp_dir, 5)
+        self.backend = CountingBackend({"tree --full-paths": ["module2/trunk/copy/", "module2/trunk/copy/1.rb"]})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_finds_paths_by_prefix(self):
+        self.assertEqual(["module1/trunk/db/migrations/", "module1/trunk/db/migrations/1.rb",
+                          "module1/trunk/db/migrations/2.rb"],
+                         list(self.snapshot.iter_under("module1/trunk/db/migrations/")))
+        self.assertEqual(sorted(self.paths), list(self.snapshot.iter_under("")))
+        self.assertEqual([], list(self.snapshot.iter_under("module3/")))
+
+    def test_lists_directory_without_reading_subdirectories(self):
+        self.assertEqual(["module1/trunk/", "module1/trunk/db/", "module1/trunk/file.txt"],
+                         list(self.snapshot.iter_children("module1/trunk/")))
+        self.assertEqual(["module1-old/", "module1/", "module2/"], list(self.snapshot.iter_children("")))
+
+    def test_finds_every_prefix_of_many_paths(self):
+        paths = sorted("module%d/trunk/%d.rb" % (module, number) for module in range(50) for number in range(20))
+        write_tree_snapshot(paths, self.temp_dir, 6)
+        snapshot = TreeSnapshot.open(self.temp_dir, 6)
+        for prefix in ["module7/", "module49/trunk/1", "module0/trunk/19.rb", "module", "x"]:
+            self.assertEqual([path for path in paths if path.startswith(prefix)], list(snapshot.iter_under(prefix)))
+
+    def test_is_missing_for_other_revisions(self):
+        self.assertEqual(None, TreeSnapshot.open(self.temp_dir, 4))
+
+    def test_answers_tree_queries_with_changes_of_commit_applied(self):
+        backend = TreeSnapshotBackend(self.backend, self.snapshot, lambda: [
+            ("D", "module1/tags/", False),
+            ("A", "module1/trunk/db/migrations/3.rb", False),
+            ("D", "module1/trunk/db/migrations/1.rb", False),
+            ("A", "module2/trunk/copy/", True)])
+        self.assertEqual(["module1/trunk/db/migrations/", "module1/trunk/db/migrations/2.rb",
+                          "module1/trunk/db/migrations/3.rb"],
+                         backend.look("tree --full-paths --non-recursive", "module1/trunk/db/migrations/"))
+        self.assertEqual(["/", "module1-old/", "module1/", "module2/"],
+                         backend.look("tree --full-paths --non-recursive", "."))
+        self.assertEqual(["module1/", "module1/trunk/", "module1/trunk/db/", "module1/trunk/db/migrations/",
+                          "module1/trunk/db/migrations/2.rb", "module1/trunk/db/migrations/3.rb",
+                          "module1/trunk/file.txt"], backend.look("tree --full-paths", "module1/"))
+        self.assertEqual(["module2/trunk/", "module2/trunk/copy/", "module2/trunk/copy/1.rb"],
+                         backend.look("tree --full-paths", "module2/trunk"))
+        self.assertEqual(["tree --full-paths"], self.backend.queries)
+
+
+class RuleSetTest(SvnLookWrapperTestCase):
+
+    def setUp(self):
+        SvnLookWrapperTestCase.setUp(self)
+        self.rules = RuleSet([
+            Rule(TAG, TAG, "*/tags/"),
+            Rule(TAG, TAG, "releases/"),
+            Rule(MIGRATION, "migrations", "*/trunk/db/migrations/", "[0-9]+.*\\.rb$"),
+            Rule(MIGRATION, "seeds", "*/trunk/db/seeds/", "[0-9]+.*\\.sql$")])
+
+    def test_classifies_paths_by_first_matching_rule(self):
+        self.assertEqual("*/tags/", self.rules.classify("module/tags/1.0/file.txt").path)
+        self.assertEqual("releases/", self.rules.classify("releases/1.0/file.txt").path)
+        self.assertEqual("seeds", self.rules.classify("module/trunk/db/seeds/1.sql").name)
+        self.assertEqual(None, self.rules.classify("module/trunk/db/seeds/1.rb"))
+        self.assertEqual(None, self.rules.classify("module/trunk/tags/file.txt"))
+        self.assertEqual(None, self.rules.classify("module/tags/"))
+
+    def test_classifies_paths_by_first_matching_rule_of_the_kind(self):
+        rules = RuleSet([Rule(ASSET, ASSET, "*/"), Rule(MIGRATION, MIGRATION, "*/tags/"), Rule(TAG, TAG, "*/tags/")])
+        self.assertEqual(ASSET, rules.classify("module/tags/1.0/file.txt").kind)
+        self.assertEqual(TAG, rules.classify("module/tags/1.0/file.txt", TAG).kind)
+        self.assertEqual(None, rules.classify("module/trunk/file.txt", TAG))
+        self.assertTrue(is_tagged("module/tags/1.0/file.txt", rules))
+
+    def test_classifies_paths_with_more_rules_than_one_pattern_supports(self):
+        rules = RuleSet([Rule(MIGRATION, "module%d" % i, "module%d/db/" % i) for i in range(250)])
+        self.assertEqual("module0", rules.classify("module0/db/1.rb").name)
+        self.assertEqual("module249", rules.classify("module249/db/1.rb").name)
+
+    def test_loads_rules_from_file(self):
+        rules_dir = tempfile.mkdtemp()
+        try:
+            rules_file = os.path.join(rules_dir, "rules.ini")
+            open(rules_file, "w").write("""[tags]
+paths = */tags/
+        */releases/
+
+[migrations seeds]
+paths = */trunk/db/seeds/
+file_pattern = [0-9]+.*\\.sql$
+""")
+            rules = load_rules("repository", rules_file)
+        finally:
+            shutil.rmtree(rules_dir)
+        self.assertEqual(TAG, rules.classify("module/releases/1.0/file.txt").kind)
+        self.assertEqual("migrations seeds", rules.classify("module/trunk/db/seeds/1.sql").name)
+
+    def test_rejects_invalid_rules_files(self):
+        rules_dir = tempfile.mkdtemp()
+        try:
+            rules_file = os.path.join(rules_dir, "rules.ini")
+            for contents in ["[tag]\npaths = */tags/\n", "[tags]\nfile_pattern = .+\n",
+                             "paths = */tags/\n", "[migrations]\npaths = */db/\nfile_pattern = [0-9\n"]:
+                open(rules_file, "w").write(contents)
+                self.assertRaises(RulesError, load_rules, "repository", rules_file)
+            self.assertRaises(RulesError, load_rules, "repository", os.path.join(rules_dir, "missing.ini"))
+        finally:
+            shutil.rmtree(rules_dir)
+
+    def test_has_no_rules_when_repository_has_no_rules_file(self):
+        self.assertEqual(None, load_rules("/nonexistent/repository"))
+
+    def test_uses_default_rules_of_kinds_missing_from_rules_file(self):
+        rules = RuleSet([Rule(MIGRATION, "migrations", "*/trunk/db/migrations/", "[0-9]+.*\\.rb$")])
+        self.assertTrue(is_tagged("module/tags/1.0/file.txt", rules))
+        self.assertTrue(is_asset("module/trunk/assets/image.png", rules))
+        self.given_file_in_commit("module/tags/1.0/file.txt")
+        self.assertEqual(1, fail_on_tag_changes(self.commit_details, rules))
+
+    def test_tag_check_uses_rules(self):
+        self.given_file_in_commit("releases/1.0/file.txt")
+        self.assertEqual(1, fail_on_tag_changes(self.commit_details, self.rules))
+
+    def test_ordered_filename_check_orders_files_of_each_rule_separately(self):
+        self.given_existing_files("module/", "trunk/db/migrations/", "5.rb")
+        self.given_existing_files("module/", "trunk/db/seeds/", "1.sql")
+        self.given_file_added_in_commit("module/trunk/db/seeds/2.sql")
+        self.given_file_added_in_commit("module/trunk/db/migrations/3.rb")
+        self.assertEqual(1, check_filenames(self.commit_details, self.repository_details, rules=self.rules))
+
+
+class TimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timings_dir = tempfile.mkdtemp()
+        self.original_timings_file = svn_look_wrappers.TIMINGS_FILE
+        svn_look_wrappers.TIMINGS_FILE = os.path.join(self.timings_dir, "timings.json")
+
+    def tearDown(self):
+        svn_look_wrappers.TIMINGS_FILE = self.original_timings_file
+        shutil.rmtree(self.timings_dir)
+
+    def recorded_timings(self):
+        return [json.loads(line) for line in open(svn_look_wrappers.TIMINGS_FILE)]
+
+    def test_records_svnlook_query(self):
+        commit_details = CommitDetails("repository", "1-1")
+        backend = mock()
+        when(backend).iter_look("log", None).thenReturn(iter(["first", "second"]))
+        commit_details._backend = backend
+        commit_details.get_commit_message()
+        [timing] = self.recorded_timings()
+        self.assertEqual(("svnlook", "log", 2, 13),
+                         (timing["type"], timing["command"], timing["lines"], timing["bytes"]))
+        self.assertTrue(timing["seconds"] >= 0)
+
+    def test_records_check(self):
+        commit_details = mock(CommitDetails)
+        when(commit_details).get_commit_message().thenReturn("..")
+        sys.stderr, original_stderr = mock(), sys.stderr
+        try:
+            check_commit_message(commit_details)
+        finally:
+            sys.stderr = original_stderr
+        [timing] = self.recorded_timings()
+        self.assertEqual(("check", "commit-message", 1),
+                         (timing["type"], timing["check"], timing["result"]))
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_shortens_timeouts_to_time_left(self):
+        deadline = Deadline(10)
+        self.assertTrue(deadline.get_timeout(30) <= 10)
+        self.assertTrue(deadline.get_timeout(None) <= 10)
+        self.assertEqual(5, deadline.get_timeout(5))
+
+    def test_raises_error_when_time_is_up(self):
+        self.assertRaises(DeadlineExceeded, Deadline(-1).get_timeout, 5)
+        self.assertRaises(DeadlineExceeded, Deadline(10).require, 20, "reading the tree")
+
+
+class ParallelExecutionTest(unittest.TestCase):
+
+    def test_returns_results_in_order(self):
+        self.assertEqual([x * 2 for x in range(20)],
+                         parallel_map(lambda x: x * 2, range(20), jobs=4))
+
+    def test_limits_number_of_concurrent_calls(self):
+        running = []
+        maximum = []
+        lock = threading.Lock()
+        def call(item):
+            with lock:
+                running.append(item)
+                maximum.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(item)
+        parallel_map(call, range(12), jobs=3)
+        self.assertEqual(3, max(maximum))
+
+    def test_raises_error_of_failed_call(self):
+        def call(item):
+            if item == 5:
+                raise ValueError(item)
+            return item
+        self.assertRaises(ValueError, parallel_map, call, range(10), jobs=4)
+
+    def test_aborts_command_after_timeout(self):
+        started = time.time()
+        self.assertRaises(SvnLookTimeout, command_output, ["sleep", "10"], 0.1)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_returns_output_of_command_within_timeout(self):
+        self.assertEqual(["1"], command_output(["echo", "1"], 5))
+
+
+class SvnLookBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_command = svn_look_wrappers.SVNLOOK_COMMAND
+        svn_look_wrappers.SVNLOOK_COMMAND = os.path.join(self.temp_dir, "svnlook")
+        stub = open(svn_look_wrappers.SVNLOOK_COMMAND, "w")
+        stub.write("#!/bin/sh\nprintf '%s\\n' \"$@\"\n")
+        stub.close()
+        os.chmod(svn_look_wrappers.SVNLOOK_COMMAND, 0700)
+
+    def tearDown(self):
+        svn_look_wrappers.SVNLOOK_COMMAND = self.original_command
+        shutil.rmtree(self.temp_dir)
+
+    def test_passes_path_with_spaces_as_single_argument(self):
+        backend = SvnLookBackend("repository", "1-1")
+        self.assertEqual(["filesize", "repository", "--transaction", "1-1", "module/a file.txt"],
+                         backend.look("filesize", "module/a file.txt"))
+        self.assertEqual("cat\nrepository\n--transaction\n1-1\nmodule/a file.txt\n",
+                         backend.read("cat", "module/a file.txt", 1024))
+
+    def test_splits_command_words_only(self):
+        backend = SvnLookBackend("repository", "1-1")
+        self.assertEqual(["tree", "--full-paths", "--non-recursive", "repository", "--transaction", "1-1",
+                          "module/my dir/"], backend.look("tree --full-paths --non-recursive", "module/my dir/"))
+
+
+class FakeRepository(object):
+    "Answers svnlook queries from paths in memory, counting the queries."
+
+    def __init__(self, commit_message="Commit message"):
+        self.commit_message = commit_message
+        self.paths = set(["/"])
+        self.changes = []
+        self.queries = []
+
+    def given_existing_file(self, path):
+        for depth in range(1, path.count("/") + 1):
+            self.paths.add("/".join(path.split("/")[:depth]) + "/")
+        self.paths.add(path)
+
+    def given_change(self, status, path, copied=False):
+        self.changes.append((status, path, copied))
+        if status != "D":
+            self.given_existing_file(path)
+
+    def create_wrappers(self):
+        commit_details = CommitDetails("repository", "1-1")
+        repository_details = RepositoryDetails("repository", "1-1")
+        commit_details._backend = repository_details._backend = self
+        return commit_details, repository_details
+
+    def youngest(self):
+        self.queries.append("youngest")
+        return 1
+
+    def look(self, command, args=None):
+        return list(self.iter_look(command, args))
+
+    def iter_look(self, command, args=None):
+        self.queries.append(command)
+        if command == "log":
+            return iter(self.commit_message.split("\n"))
+        if command == "changed --copy-info":
+            return iter([line for status, path, copied in self.changes
+                         for line in format_change(status, path, copied)])
+        if command == "filesize":
+            return iter(["10"])
+        prefix = "" if args in (None, ".") else args
+        paths = sorted(path for path in self.paths if path.startswith(prefix))
+        if command == "tree --full-paths --non-recursive":
+            return iter([path for path in paths if "/" not in path[len(prefix):].rstrip("/")])
+        return iter(paths)
+
+    def read(self, command, args, size):
+        self.queries.append(command)
+        return "text\n"
+
+
+class QueryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original_stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.original_stderr
+
+    def create_repository(self, modules, commit_size):
+        repository = FakeRepository()
+        for module in range(modules):
+            repository.given_existing_file("module%d/%s%06d.rb" % (module, MIGRATION_PATH, module))
+            repository.given_existing_file("module%d/tags/1.0/file.txt" % module)
+        for path in range(commit_size):
+            repository.given_change("A", "module%d/trunk/src/%d.txt" % (path % modules, path))
+            repository.given_change("A", "module%d/%s%06d.rb" % (path % modules, MIGRATION_PATH, modules + path))
+        repository.given_change("A", "module0/tags/2.0/", True)
+        repository.given_change("U", "module1/tags/1.0/file.txt")
+        return repository
+
+    def test_queries_of_each_check_do_not_grow_with_commit_or_repository(self):
+        budgets = {"commit-message": 1, "no-tag-changes": 2, "ordered-filenames": 3}
+        for modules, commit_size in [(2, 10), (50, 10), (2, 500), (50, 500)]:
+            for name, budget in budgets.items():
+                repository = self.create_repository(modules, commit_size)
+                commit_details, repository_details = repository.create_wrappers()
+                run_checks(commit_details, repository_details, [name])
+                self.assertTrue(len(repository.queries) <= budget, "%s with %d modules and %d changes: %s"
+                                % (name, modules, commit_size, repository.queries))
+
+    def test_migration_index_is_only_loaded_for_commits_changing_migrations(self):
+        index_dir = tempfile.mkdtemp()
+        try:
+            options = optparse.Values({"migration_index": os.path.join(index_dir, "index.json")})
+            repository = self.create_repository(50, 0)
+            repository.changes = [("A", "module0/trunk/src/file.txt", False)]
+            commit_details, repository_details = repository.create_wrappers()
+            run_checks(commit_details, repository_details, ["ordered-filenames"], options)
+            self.assertEqual(["log", "changed --copy-info"], repository.queries)
+            self.assertFalse(os.path.exists(options.migration_index))
+        finally:
+            shutil.rmtree(index_dir)
+
+    def test_migration_index_is_not_loaded_when_check_is_skipped(self):
+        repository = self.create_repository(50, 10)
+        repository.commit_message = MIGRATION_SKIP_KEYWORD
+        commit_details, repository_details = repository.create_wrappers()
+        loads = []
+        check_filenames(commit_details, repository_details, migration_index_loader=lambda: loads.append(1))
+        self.assertEqual(([], ["log"]), (loads, repository.queries))
+
+    def test_all_checks_share_queries(self):
+        repository = self.create_repository(50, 500)
+        commit_details, repository_details = repository.create_wrappers()
+        run_checks(commit_details, repository_details, ["commit-message", "no-tag-changes", "ordered-filenames"])
+        self.assertEqual(["changed --copy-info", "log", "tree --full-paths"], sorted(repository.queries))
+
+    def test_file_check_queries_each_added_file_at_most_twice(self):
+        repository = self.create_repository(50, 500)
+        commit_details, repository_details = repository.create_wrappers()
+        run_checks(commit_details, repository_details, ["no-large-or-binary-files"])
+        self.assertTrue(len(repository.queries) <= 2 + 2 * len(commit_details.get_added_files()))
+
+    def test_run_time_grows_linearly_with_commit_size(self):
+        for name in ["no-tag-changes", "ordered-filenames"]:
+            small = self.measure(name, 1000)
+            large = self.measure(name, 8000)
+            self.assertTrue(large < small * 8 * 3, "%s took %.3fs for 1000 changes and %.3fs for 8000"
+                            % (name, small, large))
+
+    def measure(self, name, commit_size):
+        repository = self.create_repository(20, commit_size)
+        timings = []
+        for i in range(3):
+            commit_details, repository_details = repository.create_wrappers()
+            started = time.time()
+            run_checks(commit_details, repository_details, [name])
+            timings.append(time.time() - started)
+        return min(timings)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
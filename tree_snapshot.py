@@ -0,0 +1,190 @@
+import os
+import mmap
+import heapq
+import itertools
+import tempfile
+
+# Bytes read at a time when streaming many lines of a snapshot
+READ_SIZE = 1024 * 1024
+
+def get_snapshot_path(directory, revision):
+    return os.path.join(directory, "%d.paths" % revision)
+
+def get_directory_prefix(directory):
+    "Returns the prefix of the paths in a directory, \"\" for the root."
+    directory = (directory or "").strip("/")
+    if directory in ("", "."):
+        return ""
+    return directory + "/"
+
+class TreeSnapshot(object):
+    """All paths of a repository revision but the root, as a sorted newline
+    delimited file that is memory mapped. Since the paths below a directory
+    are adjacent in sorted order, listings and prefix lookups are binary
+    searches over the mapped file, which is paged in only where it is read."""
+
+    def __init__(self, path):
+        snapshot_file = open(path, "rb")
+        try:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            self._map = mmap.mmap(snapshot_file.fileno(), size, access=mmap.ACCESS_READ) if size else ""
+        finally:
+            snapshot_file.close()
+
+    @classmethod
+    def open(cls, directory, revision):
+        "Returns the snapshot of the revision, or None if there is none."
+        try:
+            return cls(get_snapshot_path(directory, revision))
+        except (IOError, OSError):
+            return None
+
+    def iter_under(self, prefix):
+        "Yields the paths starting with the prefix, in sorted order."
+        return self._iter_lines(self._find(prefix), self._find_end(prefix))
+
+    def iter_children(self, prefix):
+        """Yields the directory prefix and the paths directly below it, skipping
+        over the contents of subdirectories."""
+        position = self._find(prefix)
+        end = self._find_end(prefix)
+        while position < end:
+            line_end = self._map.find("\n", position)
+            path = self._map[position:line_end]
+            yield path
+            if path.endswith("/") and path != prefix:
+                position = self._find_end(path)
+            else:
+                position = line_end + 1
+
+    def _find(self, key):
+        "Returns the offset of the first line that is not less than key."
+        low, high = 0, len(self._map)
+        while low < high:
+            start = self._map.rfind("\n", low, (low + high) // 2) + 1 or low
+            end = self._map.find("\n", start)
+            if self._map[start:end] < key:
+                low = end + 1
+            else:
+                high = start
+        return low
+
+    def _find_end(self, prefix):
+        "Returns the offset of the first line after those starting with the prefix."
+        if not prefix:
+            return len(self._map)
+        return self._find(prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix[-1] != "\xff" else len(self._map)
+
+    def _iter_lines(self, start, end):
+        remainder = ""
+        while start < end:
+            chunk = remainder + self._map[start:min(start + READ_SIZE, end)]
+            start += READ_SIZE
+            lines = chunk.split("\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+class TreeOverlay(object):
+    """A TreeSnapshot with the changes of a later commit applied, given as
+    (status, path, copied) changes. The contents of copied directories are
+    read with list_directory, since the changes only name the directory."""
+
+    def __init__(self, snapshot, changes, list_directory):
+        self._snapshot = snapshot
+        self._deleted = set()
+        self._deleted_directories = []
+        added = set()
+        for status, path, copied in changes:
+            if status in ("D", "R"):
+                if path.endswith("/"):
+                    self._deleted_directories.append(path)
+                else:
+                    self._deleted.add(path)
+            if status in ("A", "R"):
+                if copied and path.endswith("/"):
+                    added.update(list_directory(path))
+                else:
+                    added.add(path)
+        self._deleted_directories = tuple(self._deleted_directories)
+        self._added = sorted(added)
+
+    def iter_under(self, prefix):
+        "Yields the paths starting with the prefix, in sorted order."
+        return self._merge(self._snapshot.iter_under(prefix),
+                           [path for path in self._added if path.startswith(prefix)])
+
+    def iter_children(self, prefix):
+        "Yields the directory prefix and the paths directly below it."
+        return self._merge(self._snapshot.iter_children(prefix),
+                           [path for path in self._added if path.startswith(prefix) and
+                            "/" not in path[len(prefix):].rstrip("/")])
+
+    def _merge(self, existing_paths, added_paths):
+        last = None
+        for path in heapq.merge(self._iter_existing(existing_paths), added_paths):
+            if path != last:
+                yield path
+                last = path
+
+    def _iter_existing(self, paths):
+        for path in paths:
+            if path in self._deleted or (self._deleted_directories and path.startswith(self._deleted_directories)):
+                continue
+            yield path
+
+class TreeSnapshotBackend(object):
+    """Answers tree queries from a TreeSnapshot overlaid with the changes of the
+    commit, producing the same output as svnlook. Other queries are passed on."""
+
+    def __init__(self, backend, snapshot, get_changes):
+        self._backend = backend
+        self._snapshot = snapshot
+        self._get_changes = get_changes
+        self._overlay = None
+
+    def youngest(self):
+        return self._backend.youngest()
+
+    def iter_look(self, command, args=None):
+        words = command.split()
+        if words[0] == "tree" and "--full-paths" in words:
+            return self._tree(args, "--non-recursive" not in words)
+        return self._backend.iter_look(command, args)
+
+    def look(self, command, args=None):
+        return list(self.iter_look(command, args))
+
+    def read(self, command, args, size):
+        return self._backend.read(command, args, size)
+
+    def _tree(self, directory, recursive):
+        if self._overlay is None:
+            self._overlay = TreeOverlay(self._snapshot, self._get_changes(),
+                                        lambda directory: self._backend.iter_look("tree --full-paths", directory))
+        prefix = get_directory_prefix(directory)
+        if recursive:
+            paths = self._overlay.iter_under(prefix)
+        else:
+            paths = self._overlay.iter_children(prefix)
+        if not prefix:
+            paths = itertools.chain(["/"], paths)
+        return paths
+
+def write_tree_snapshot(paths, directory, revision):
+    "Writes the sorted paths as the snapshot of the revision, replacing any snapshot atomically."
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".tree-snapshot-")
+    try:
+        snapshot_file = os.fdopen(handle, "wb")
+        try:
+            for path in paths:
+                if path != "/":
+                    snapshot_file.write(path + "\n")
+        finally:
+            snapshot_file.close()
+        os.rename(temp_path, get_snapshot_path(directory, revision))
+    except:
+        os.remove(temp_path)
+        raise
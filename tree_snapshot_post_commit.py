@@ -0,0 +1,46 @@
+#!/usr/bin/python
+import os
+import sys
+import optparse
+from svn_look_wrappers import CommitDetails, RepositoryDetails, SvnLookError
+from tree_snapshot import write_tree_snapshot, get_snapshot_path
+
+# Number of the latest revisions whose snapshots are kept
+TREE_SNAPSHOTS_KEPT = 2
+
+def update_tree_snapshot(repository, revision, directory):
+    """Writes the snapshot of the revision from the snapshot of the previous
+    revision and the changes of the revision, or from the whole repository
+    tree if there is no previous snapshot. Older snapshots are removed."""
+    repository_details = RepositoryDetails(repository, revision, test_mode=True)
+    commit_details = CommitDetails(repository, revision, test_mode=True)
+    if repository_details.use_tree_snapshot(directory, commit_details):
+        paths = repository_details.iter_tree()
+    else:
+        paths = sorted(repository_details.iter_tree())
+    write_tree_snapshot(paths, directory, revision)
+    for name in os.listdir(directory):
+        old_revision = name[:-len(".paths")]
+        if name.endswith(".paths") and old_revision.isdigit() and \
+                int(old_revision) <= revision - TREE_SNAPSHOTS_KEPT:
+            os.remove(get_snapshot_path(directory, int(old_revision)))
+
+def main():
+    usage = """Usage: %prog REPOS REV DIR
+
+Runs post-commit, writing the sorted snapshot of all paths of the committed
+revision to DIR, for the --tree-snapshot option of the pre-commit scripts."""
+    parser = optparse.OptionParser(usage=usage)
+    try:
+        (options, (repos, revision, directory)) = parser.parse_args()
+        update_tree_snapshot(repos, int(revision), directory)
+        return 0
+    except SvnLookError as error:
+        sys.stderr.write("Error: %s\n" % error)
+        return 1
+    except:
+        parser.print_help()
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())